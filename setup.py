@@ -27,13 +27,17 @@ setup(
     install_requires=[
         'setuptools',
         'Flask',
+        'numpy',
     ],
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update_xml = presence_analyzer.update_xml:update_xml_file
+    export_presence = presence_analyzer.export:export_aggregates
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+    [paste.server_runner]
+    prefork = presence_analyzer.prefork:server_runner
     """,
 )
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer.
-"""
 
-from .main import APP
-from . import views
+The application and its views are imported lazily (see script.make_app),
+so that short command line entry points don't pay for Flask, Mako and lxml.
+"""
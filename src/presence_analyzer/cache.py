@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backends.
+
+A backend is a mapping of cache keys to entries: dicts with 'time',
+'value' and optionally 'tag' telling which data the value was computed
+from. Backends support get, item assignment, pop and clear, so the
+in-process backend is a plain dict.
+"""
+
+import cPickle as pickle
+import logging
+import os
+import sqlite3
+
+from threading import local
+
+LOG = logging.getLogger(__name__)
+
+
+class LocalCache(dict):
+    """
+    Cache kept in memory of one process.
+    """
+
+
+class SQLiteCache(object):
+    """
+    Cache kept in an SQLite file shared by all processes on the host.
+
+    Values are pickled. Errors of the store are logged and treated
+    as cache misses, so a broken file never breaks a request.
+    """
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.connections = local()
+
+    def connection(self):
+        """
+        Connection of the current thread, opened again after fork.
+        """
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None or self.connections.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None
+            )
+            connection.text_factory = str
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.OperationalError:
+                LOG.debug('Journal mode of %s not changed.', self.path)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, time INTEGER, tag TEXT, value BLOB)'
+            )
+            self.connections.connection = connection
+            self.connections.pid = os.getpid()
+        return connection
+
+    def get(self, key, default=None):
+        """
+        Entry stored under given key.
+        """
+        try:
+            row = self.connection().execute(
+                'SELECT time, tag, value FROM cache WHERE key = ?',
+                (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            LOG.warning('Cache %s can\'t be read.', self.path, exc_info=True)
+            return default
+        if row is None:
+            return default
+        return {
+            'time': row[0],
+            'tag': row[1],
+            'value': pickle.loads(str(row[2])),
+        }
+
+    def __setitem__(self, key, entry):
+        try:
+            self.connection().execute(
+                'INSERT OR REPLACE INTO cache (key, time, tag, value) '
+                'VALUES (?, ?, ?, ?)',
+                (
+                    key,
+                    entry['time'],
+                    entry.get('tag'),
+                    sqlite3.Binary(pickle.dumps(entry['value'], 2)),
+                )
+            )
+        except sqlite3.Error:
+            LOG.warning(
+                'Cache %s can\'t be written.', self.path, exc_info=True
+            )
+
+    def pop(self, key, default=None):
+        """
+        Removes entry stored under given key and returns it.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return default
+        try:
+            self.connection().execute(
+                'DELETE FROM cache WHERE key = ?', (key,)
+            )
+        except sqlite3.Error:
+            LOG.warning(
+                'Cache %s can\'t be written.', self.path, exc_info=True
+            )
+        return entry
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        try:
+            self.connection().execute('DELETE FROM cache')
+        except sqlite3.Error:
+            LOG.warning(
+                'Cache %s can\'t be written.', self.path, exc_info=True
+            )
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk export of per-user presence aggregates.
+
+Aggregates are produced user by user from a generator and serialized row
+by row, so the export is streamed and never built in memory as a whole.
+"""
+
+import argparse
+import calendar
+import csv
+import json
+import sys
+
+from datetime import datetime
+
+from presence_analyzer.main import APP
+from presence_analyzer.utils import (
+    STREAM_CHUNK_SIZE, get_data, weekday_totals
+)
+
+COLUMNS = (
+    'user_id', 'weekday', 'days', 'total', 'mean', 'mean_start', 'mean_end'
+)
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class LineBuffer(object):
+    """
+    File-like object keeping the last line written by csv.writer.
+    """
+
+    def __init__(self):
+        self.line = ''
+
+    def write(self, line):
+        """
+        Keeps the written line.
+        """
+        self.line = line
+
+
+def parse_date(text):
+    """
+    Parses YYYY-MM-DD date, None for an empty one.
+    """
+    if not text:
+        return None
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def user_aggregates(data, users=None, since=None, until=None):
+    """
+    Yields presence count, total and mean time, mean start and end
+    of every user by weekday, in order of user ids.
+
+    'users' limits the export to given user ids, 'since' and 'until'
+    to an inclusive range of dates.
+    """
+    user_ids = sorted(data if users is None else set(users) & set(data))
+    for user_id in user_ids:
+        week = weekday_totals(data[user_id], since, until)
+        for weekday, (days, total, starts, ends) in enumerate(week):
+            yield {
+                'user_id': user_id,
+                'weekday': calendar.day_abbr[weekday],
+                'days': days,
+                'total': total,
+                'mean': float(total) / days if days else 0,
+                'mean_start': float(starts) / days if days else 0,
+                'mean_end': float(ends) / days if days else 0,
+            }
+
+
+def iter_csv(rows):
+    """
+    Yields CSV with a header row in chunks of about STREAM_CHUNK_SIZE.
+    """
+    buf = LineBuffer()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    chunk = [buf.line]
+    size = len(buf.line)
+    for row in rows:
+        writer.writerow([row[column] for column in COLUMNS])
+        chunk.append(buf.line)
+        size += len(buf.line)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    yield ''.join(chunk)
+
+
+def iter_ndjson(rows):
+    """
+    Yields one JSON object per line in chunks of about STREAM_CHUNK_SIZE.
+    """
+    chunk = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, sort_keys=True) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    yield ''.join(chunk)
+
+
+def iter_export(data, output_format, users=None, since=None, until=None):
+    """
+    Yields chunks of the export in 'csv' or 'ndjson' format.
+    """
+    rows = user_aggregates(data, users, since, until)
+    if output_format == 'csv':
+        return iter_csv(rows)
+    return iter_ndjson(rows)
+
+
+def export_aggregates(argv=None):
+    """
+    Writes the export to standard output or a file.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--config', help='application configuration file')
+    parser.add_argument(
+        '--format', choices=sorted(FORMATS), default='csv',
+        help='output format, csv by default'
+    )
+    parser.add_argument(
+        '--user', type=int, action='append', dest='users',
+        help='export only given user, may be repeated'
+    )
+    parser.add_argument(
+        '--since', type=parse_date, help='first date, YYYY-MM-DD'
+    )
+    parser.add_argument(
+        '--until', type=parse_date, help='last date, YYYY-MM-DD'
+    )
+    parser.add_argument('--output', help='output file, standard output')
+    args = parser.parse_args(argv)
+    if args.config:
+        APP.config.from_pyfile(args.config)
+    else:
+        from presence_analyzer.script import DEPLOY_CFG, abspath
+        APP.config.from_pyfile(abspath(DEPLOY_CFG))
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for chunk in iter_export(
+                get_data(), args.format, args.users, args.since, args.until):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Byte-offset index of users' rows in a presence CSV file.
+
+One scan of the file maps every user_id to byte ranges of its rows. The
+index is kept in a sidecar file next to the CSV and rebuilt when the stat
+signature of the CSV changes. Rows of one user are then read through mmap
+and parsed on demand, recently parsed users are kept in an LRU. Rows are
+validated by the same scan, so rejected rows are known for the whole file.
+"""
+
+import json
+import logging
+import mmap
+import os
+import tempfile
+
+from collections import OrderedDict
+from threading import RLock
+
+from presence_analyzer.shards import signature
+
+LOG = logging.getLogger(__name__)
+
+
+def index_path(path):
+    """
+    Path of the sidecar index of given CSV file.
+    """
+    return path + '.idx'
+
+
+def build_index(path, validate=None):
+    """
+    Scans CSV file for byte ranges of rows of every user, consecutive rows
+    of a user make one range. Rows without a numeric user_id are skipped.
+
+    'validate' takes a line number and the line and returns None for lines
+    which aren't rows, an empty list for a valid row and [category] +
+    fields for a rejected one. Returns ranges, number of rows and rejected
+    rows with their line numbers.
+    """
+    ranges = {}
+    rows = 0
+    rejected = []
+    offset = 0
+    with open(path, 'rb') as csvfile:
+        for number, line in enumerate(csvfile, 1):
+            end = offset + len(line)
+            if validate is not None:
+                result = validate(number, line)
+                if result is not None:
+                    rows += 1
+                if result:
+                    rejected.append([number] + result)
+            try:
+                user_id = int(line.split(',', 1)[0])
+            except ValueError:
+                offset = end
+                continue
+            user_ranges = ranges.setdefault(user_id, [])
+            if user_ranges and user_ranges[-1][1] == offset:
+                user_ranges[-1][1] = end
+            else:
+                user_ranges.append([offset, end])
+            offset = end
+    return ranges, rows, rejected
+
+
+def load_index(path, current, validate=None):
+    """
+    Byte ranges of users, number of rows and rejected rows from the
+    sidecar index, built again and saved when it's missing or doesn't
+    match 'current' signature of the CSV.
+    """
+    try:
+        with open(index_path(path)) as index_file:
+            index = json.load(index_file)
+        if tuple(index['signature']) == current:
+            return (
+                {
+                    int(user_id): user_ranges
+                    for user_id, user_ranges in index['users'].iteritems()
+                },
+                index['rows'],
+                index['rejected'],
+            )
+    except (IOError, ValueError, KeyError, TypeError):
+        LOG.debug('Index of %s is missing or broken.', path)
+
+    ranges, rows, rejected = build_index(path, validate)
+    try:
+        descriptor, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path))
+        )
+        with os.fdopen(descriptor, 'w') as index_file:
+            json.dump({
+                'signature': current,
+                'users': ranges,
+                'rows': rows,
+                'rejected': rejected,
+            }, index_file)
+        os.rename(temp_path, index_path(path))
+    except (IOError, OSError):
+        LOG.warning('Index of %s can\'t be saved.', path, exc_info=True)
+    return ranges, rows, rejected
+
+
+class UserIndex(object):
+    """
+    Rows of a CSV file loaded user by user.
+
+    'parse' turns a list of CSV lines into presence of a user,
+    'on_reload' is called with ids of users whose rows have changed,
+    'validate' checks lines while the index is built.
+    """
+
+    def __init__(self, path, parse, max_users, on_reload=None,
+                 validate=None):
+        # pylint: disable=too-many-arguments
+        self.path = path
+        self.parse = parse
+        self.max_users = max_users
+        self.on_reload = on_reload
+        self.validate = validate
+        self.signature = None
+        self.ranges = {}
+        self.rows = 0
+        self.rejected = []
+        self.parsed = OrderedDict()
+        self.lock = RLock()
+
+    def refresh(self):
+        """
+        Loads the index again when the CSV file has changed.
+        """
+        current = signature(self.path)
+        if current == self.signature:
+            return
+        with self.lock:
+            if current == self.signature:
+                return
+            ranges, rows, rejected = load_index(
+                self.path, current, self.validate
+            )
+            changed = set(
+                user_id
+                for user_id in set(ranges) | set(self.ranges)
+                if ranges.get(user_id) != self.ranges.get(user_id)
+            )
+            first_load = self.signature is None
+            self.ranges = ranges
+            self.rows = rows
+            self.rejected = rejected
+            self.signature = current
+            for user_id in changed:
+                self.parsed.pop(user_id, None)
+        if changed and not first_load and self.on_reload is not None:
+            self.on_reload(changed)
+
+    def user_ids(self):
+        """
+        Sorted ids of users in the file.
+        """
+        self.refresh()
+        return sorted(self.ranges)
+
+    def get(self, user_id):
+        """
+        Presence of given user, None when there are no rows of the user.
+
+        Rows are read and parsed without holding the lock, so users are
+        parsed concurrently.
+        """
+        self.refresh()
+        with self.lock:
+            days = self.parsed.pop(user_id, None)
+            if days is not None:
+                self.parsed[user_id] = days
+                return days
+            user_ranges = self.ranges.get(user_id)
+            current = self.signature
+        if user_ranges is None:
+            return None
+        days = self.parse(self.read(user_ranges))
+        with self.lock:
+            if self.signature == current:
+                self.parsed[user_id] = days
+                while len(self.parsed) > self.max_users:
+                    self.parsed.popitem(last=False)
+        return days
+
+    def read(self, user_ranges):
+        """
+        Lines of the CSV file in given byte ranges.
+        """
+        with open(self.path, 'rb') as csvfile:
+            mapped = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return ''.join(
+                    mapped[start:end] for start, end in user_ranges
+                ).splitlines()
+            finally:
+                mapped.close()
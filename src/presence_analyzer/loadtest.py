@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP load test of a running instance.
+
+Concurrent clients request a weighted mix of API routes filled with user
+ids and dates of the loaded presence data. The report holds throughput,
+latency percentiles and error rate, so runs can be compared as JSON.
+"""
+
+import random
+import threading
+import time
+import urllib2
+
+ROUTES = (
+    # (weight, path template), templates take 'user_id' and 'date'
+    (20, '/api/v1/presence_weekday/{user_id}'),
+    (20, '/api/v1/mean_time_weekday/{user_id}'),
+    (15, '/api/v1/presence_start_end/{user_id}'),
+    (10, '/api/v1/presence_distribution/{user_id}'),
+    (10, '/api/v1/top_five/{date}'),
+    (5, '/api/v1/top_employees/{date}'),
+    (5, '/api/v1/users'),
+    (5, '/api/v1/days/'),
+    (4, '/api/v1/org/mean_start_end'),
+    (3, '/api/v1/org/headcount?limit=100'),
+    (3, '/api/v1/org/monthly_presence'),
+)
+
+
+def build_paths(data, count, routes=ROUTES, seed=None):
+    """
+    Paths of 'count' requests drawn from weighted routes, filled with
+    user ids and dates of given presence data.
+    """
+    rng = random.Random(seed)
+    user_ids = sorted(data)
+    dates = sorted(set(
+        day.strftime('%y%m%d') for days in data.itervalues() for day in days
+    ))
+    total = sum(weight for weight, _ in routes)
+    paths = []
+    for _ in xrange(count):
+        point = rng.uniform(0, total)
+        for weight, template in routes:
+            point -= weight
+            if point <= 0:
+                break
+        paths.append(template.format(
+            user_id=rng.choice(user_ids),
+            date=rng.choice(dates)
+        ))
+    return paths
+
+
+def percentile(ordered, percent):
+    """
+    Nearest-rank percentile of sorted values, zero when there are none.
+    """
+    if not ordered:
+        return 0
+    rank = max(1, -(-percent * len(ordered) // 100))
+    return ordered[rank - 1]
+
+
+def fetch(url, timeout):
+    """
+    Requests given URL, returns its status code, 0 when it can't connect.
+    """
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+        response.read()
+        return response.getcode()
+    except urllib2.HTTPError as error:
+        return error.code
+    except IOError:
+        return 0
+
+
+def run(base_url, paths, clients=10, timeout=30):
+    """
+    Requests paths by concurrent clients, returns the report.
+    """
+    pending = iter(paths)
+    lock = threading.Lock()
+    results = []  # (path, status, seconds)
+
+    def client():
+        """
+        Takes next path until all of them are requested.
+        """
+        while True:
+            with lock:
+                path = next(pending, None)
+            if path is None:
+                return
+            started = time.time()
+            status = fetch(base_url + path, timeout)
+            results.append((path, status, time.time() - started))
+
+    threads = [threading.Thread(target=client) for _ in xrange(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return report(results, time.time() - started, clients)
+
+
+def report(results, elapsed, clients):
+    """
+    Throughput, latency percentiles in milliseconds and error rate.
+
+    Responses other than 2xx and 304 count as errors.
+    """
+    latencies = sorted(seconds * 1000 for _, _, seconds in results)
+    errors = {}
+    for _, status, _ in results:
+        if not (200 <= status < 300 or status == 304):
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    requests = len(results)
+    return {
+        'clients': clients,
+        'requests': requests,
+        'seconds': round(elapsed, 3),
+        'throughput': round(requests / elapsed, 2) if elapsed else 0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'max': round(latencies[-1], 2) if latencies else 0,
+        },
+        'errors': errors,
+        'error_rate': (
+            round(float(sum(errors.values())) / requests, 4)
+            if requests else 0
+        ),
+    }
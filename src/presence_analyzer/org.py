@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Organisation-wide statistics.
+
+Presence data is converted once per data version into NumPy columns,
+statistics are aggregated over the whole columns at once. Pure Python
+reference implementations are kept for tests and benchmarks.
+"""
+
+import calendar
+import itertools
+import time
+
+from datetime import date
+
+import numpy
+
+from presence_analyzer.utils import depends_on, get_data, mean
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@depends_on()
+def get_columns():
+    """
+    Presence data as NumPy columns: user_id, ordinal, start and end.
+    """
+    data = get_data()
+    user_ids = sorted(data)
+    counts = [len(data[user_id]) for user_id in user_ids]
+    records = numpy.fromiter(
+        itertools.chain.from_iterable(
+            itertools.chain.from_iterable(
+                data[user_id].itervalues() for user_id in user_ids
+            )
+        ),
+        dtype=numpy.int32,
+        count=3 * sum(counts)
+    ).reshape(-1, 3)
+    return {
+        'user_id': numpy.repeat(
+            numpy.array(user_ids, dtype=numpy.int32),
+            counts
+        ),
+        'ordinal': records[:, 0],
+        'start': records[:, 1],
+        'end': records[:, 2],
+    }
+
+
+def weekdays(ordinals):
+    """
+    Weekdays (Monday is 0) of date ordinals.
+    """
+    return (ordinals + 6) % 7
+
+
+def months(ordinals):
+    """
+    Months of date ordinals as numpy.datetime64.
+    """
+    return (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype(
+        'datetime64[M]'
+    )
+
+
+def divide(totals, counts):
+    """
+    Element-wise mean from totals and counts, zero where count is zero.
+    """
+    result = numpy.zeros(len(totals))
+    numpy.divide(totals, counts, out=result, where=counts > 0)
+    return result
+
+
+def mean_start_end_by_weekday(columns):
+    """
+    Mean start and end of presence of all users grouped by weekday.
+    """
+    days = weekdays(columns['ordinal'])
+    counts = numpy.bincount(days, minlength=7)
+    starts = divide(
+        numpy.bincount(days, weights=columns['start'], minlength=7),
+        counts
+    )
+    ends = divide(
+        numpy.bincount(days, weights=columns['end'], minlength=7),
+        counts
+    )
+    return [
+        [calendar.day_abbr[weekday], start, end]
+        for weekday, start, end in zip(
+            xrange(7), starts.tolist(), ends.tolist()
+        )
+    ]
+
+
+def headcount_by_day(columns):
+    """
+    Number of present users per day.
+    """
+    ordinals, counts = numpy.unique(columns['ordinal'], return_counts=True)
+    return [
+        [date.fromordinal(ordinal).isoformat(), count]
+        for ordinal, count in zip(ordinals.tolist(), counts.tolist())
+    ]
+
+
+def mean_presence_by_month(columns):
+    """
+    Mean presence time per present user and day, and number
+    of such user days, grouped by month.
+    """
+    month_ids, inverse = numpy.unique(
+        months(columns['ordinal']),
+        return_inverse=True
+    )
+    counts = numpy.bincount(inverse)
+    totals = numpy.bincount(
+        inverse,
+        weights=columns['end'] - columns['start']
+    )
+    return [
+        [str(month), presence, count]
+        for month, presence, count in zip(
+            month_ids, divide(totals, counts).tolist(), counts.tolist()
+        )
+    ]
+
+
+def mean_start_end_by_weekday_reference(data):
+    """
+    Pure Python version of mean_start_end_by_weekday.
+    """
+    week = [([], []) for _ in xrange(7)]
+    for days in data.itervalues():
+        for day, presence in days.iteritems():
+            week[day.weekday()][0].append(presence.start)
+            week[day.weekday()][1].append(presence.end)
+    return [
+        [calendar.day_abbr[weekday], mean(starts), mean(ends)]
+        for weekday, (starts, ends) in enumerate(week)
+    ]
+
+
+def headcount_by_day_reference(data):
+    """
+    Pure Python version of headcount_by_day.
+    """
+    headcount = {}
+    for days in data.itervalues():
+        for day in days:
+            headcount[day] = headcount.get(day, 0) + 1
+    return [
+        [day.isoformat(), count] for day, count in sorted(headcount.items())
+    ]
+
+
+def mean_presence_by_month_reference(data):
+    """
+    Pure Python version of mean_presence_by_month.
+    """
+    by_month = {}
+    for days in data.itervalues():
+        for day, presence in days.iteritems():
+            by_month.setdefault(day.strftime('%Y-%m'), []).append(
+                presence.end - presence.start
+            )
+    return [
+        [month, mean(presences), len(presences)]
+        for month, presences in sorted(by_month.items())
+    ]
+
+
+def benchmark(repeat=5):
+    """
+    Best times in seconds of vectorized and reference implementations.
+    """
+    data = get_data()
+    columns = get_columns()
+    results = {}
+    for name in (
+            'mean_start_end_by_weekday',
+            'headcount_by_day',
+            'mean_presence_by_month'):
+        for implementation, argument in (
+                (globals()[name], columns),
+                (globals()[name + '_reference'], data)):
+            timings = []
+            for _ in xrange(repeat):
+                started = time.time()
+                implementation(argument)
+                timings.append(time.time() - started)
+            results[implementation.__name__] = min(timings)
+    return results
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking WSGI server.
+
+The master process binds one listening socket, warms up the application data
+and forks worker processes which accept connections on the shared socket,
+each of them serving requests from its own Paste thread pool.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from paste import httpserver
+
+LOG = logging.getLogger(__name__)
+KILL_DELAY = 5  # seconds after graceful_timeout before workers are killed
+
+
+class SharedSocketServer(httpserver.WSGIThreadPoolServer):
+    """
+    Thread pool server accepting connections on an already bound socket.
+    """
+
+    def __init__(self, wsgi_application, listener, threads=10,
+                 max_requests=0, graceful_timeout=30):
+        # pylint: disable=too-many-arguments
+        self.listener = listener
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.handled_requests = 0
+        httpserver.WSGIThreadPoolServer.__init__(
+            self,
+            wsgi_application,
+            listener.getsockname(),
+            httpserver.WSGIHandler,
+            nworkers=threads,
+            threadpool_options={'spawn_if_under': min(threads, 5)},
+        )
+
+    def server_bind(self):
+        """
+        Replaces the freshly created socket with the shared listener.
+        """
+        self.socket.close()
+        self.socket = self.listener
+        host, port = self.socket.getsockname()[:2]
+        self.server_address = (host, port)
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def serve_forever(self):
+        """
+        Serves until stopped, then lets accepted requests finish.
+        """
+        try:
+            while self.running:
+                try:
+                    self.handle_request()
+                except socket.timeout:
+                    pass
+        finally:
+            self.drain()
+
+    def drain(self):
+        """
+        Shuts the thread pool down once accepted requests are finished,
+        threads still busy after graceful_timeout are killed.
+        """
+        pool = self.thread_pool
+        workers = list(pool.workers)
+        for _ in workers:
+            pool.queue.put(httpserver.ThreadPool.SHUTDOWN)
+        deadline = time.time() + self.graceful_timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+        pool.shutdown()
+
+    def process_request(self, request, client_address):
+        """
+        Counts handled requests and stops accepting after max_requests.
+        """
+        self.handled_requests += 1
+        httpserver.WSGIThreadPoolServer.process_request(
+            self, request, client_address
+        )
+        if self.max_requests and self.handled_requests >= self.max_requests:
+            LOG.info(
+                'Worker %s handled %d requests, recycling.',
+                os.getpid(),
+                self.handled_requests
+            )
+            self.running = False
+
+    def handle_timeout(self):
+        """
+        Stops the worker when its master process is gone.
+        """
+        if os.getppid() == 1:
+            LOG.warning('Master of worker %s is gone.', os.getpid())
+            self.running = False
+
+
+class PreforkMaster(object):
+    """
+    Forks and supervises worker processes.
+
+    SIGHUP warms up the application again and gracefully replaces
+    all workers, SIGTERM and SIGINT gracefully stop the server. With
+    'warmed' the application isn't warmed up again before the first
+    workers are forked.
+    """
+
+    def __init__(self, wsgi_application, host, port, workers=4, threads=10,
+                 max_requests=0, request_queue_size=5, warm_up=None,
+                 graceful_timeout=30, warmed=False):
+        self.wsgi_application = wsgi_application
+        self.address = (host, port)
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.request_queue_size = request_queue_size
+        self.warm_up = warm_up
+        self.graceful_timeout = graceful_timeout
+        self.warmed = warmed
+        self.listener = None
+        self.children = {}
+        self.generation = 0
+        self.alive = True
+        self.reload_requested = False
+
+    def bind(self):
+        """
+        Creates the listening socket shared by all workers.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(self.request_queue_size)
+        self.listener = listener
+
+    def serve_forever(self):
+        """
+        Runs the master loop until the server is stopped.
+        """
+        if self.listener is None:
+            self.bind()
+        if not self.warmed:
+            self.warm()
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        LOG.info(
+            'Serving on %s:%s with %d workers, %d threads each.',
+            self.address[0],
+            self.address[1],
+            self.workers,
+            self.threads
+        )
+        try:
+            while self.alive:
+                if self.reload_requested:
+                    self.reload()
+                self.reap_workers()
+                self.spawn_workers()
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def warm(self):
+        """
+        Preloads application data before any worker accepts connections.
+        """
+        if self.warm_up is not None:
+            started = time.time()
+            self.warm_up()
+            LOG.info('Warm-up finished in %.2fs.', time.time() - started)
+
+    def spawn_workers(self):
+        """
+        Forks workers of the current generation until there are enough.
+        """
+        current = [
+            pid for pid, generation in self.children.items()
+            if generation == self.generation
+        ]
+        for _ in xrange(self.workers - len(current)):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self.children[pid] = self.generation
+
+    def run_worker(self):
+        """
+        Serves requests in a forked worker process, never returns.
+        """
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            server = SharedSocketServer(
+                self.wsgi_application,
+                self.listener,
+                threads=self.threads,
+                max_requests=self.max_requests,
+                graceful_timeout=self.graceful_timeout,
+            )
+
+            def handle_stop(signum, frame):  # pylint: disable=unused-argument
+                """
+                Stops accepting connections and lets pending requests finish.
+                """
+                server.running = False
+
+            signal.signal(signal.SIGTERM, handle_stop)
+            server.serve_forever()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Worker %s crashed.', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+
+    def reap_workers(self):
+        """
+        Forgets about workers which have exited.
+        """
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                raise
+            if pid == 0:
+                break
+            self.children.pop(pid, None)
+
+    def reload(self):
+        """
+        Warms up again and replaces all workers with a new generation.
+        """
+        self.reload_requested = False
+        LOG.info('Reloading workers.')
+        self.warm()
+        old_workers = self.children.keys()
+        self.generation += 1
+        self.spawn_workers()
+        self.kill_workers(old_workers)
+
+    def kill_workers(self, pids, signum=signal.SIGTERM):
+        """
+        Sends a signal to given workers.
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+                self.children.pop(pid, None)
+
+    def stop(self):
+        """
+        Gracefully stops all workers, kills those still running
+        KILL_DELAY seconds after graceful_timeout.
+        """
+        self.kill_workers(self.children.keys())
+        deadline = time.time() + self.graceful_timeout + KILL_DELAY
+        while self.children and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        self.kill_workers(self.children.keys(), signal.SIGKILL)
+        self.reap_workers()
+
+    def handle_reload(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        SIGHUP handler.
+        """
+        self.reload_requested = True
+
+    def handle_stop(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        SIGTERM and SIGINT handler.
+        """
+        self.alive = False
+
+
+def warm_up():
+    """
+    Default warm-up, preloads data and compiles templates.
+    """
+    from presence_analyzer.script import warm_up as warm_up_app
+    warm_up_app()
+
+
+# [server:prefork] in parts/etc/deploy.ini
+def server_runner(wsgi_app, global_conf, host='0.0.0.0', port=8080,
+                  workers=4, threads=10, max_requests=0,
+                  request_queue_size=5, graceful_timeout=30):
+    """
+    Paste server runner for the pre-forking server.
+
+    The application warmed up by make_app isn't warmed up again.
+    """
+    # pylint: disable=unused-argument,too-many-arguments
+    from presence_analyzer.script import warmed_up
+    master = PreforkMaster(
+        wsgi_app,
+        host,
+        int(port),
+        workers=int(workers),
+        threads=int(threads),
+        max_requests=int(max_requests),
+        request_queue_size=int(request_queue_size),
+        warm_up=warm_up,
+        graceful_timeout=float(graceful_timeout),
+        warmed=warmed_up(),
+    )
+    master.serve_forever()
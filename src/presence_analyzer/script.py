@@ -3,11 +3,13 @@
 # pylint:skip-file
 
 import os
+import signal
 import sys
+import time
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
+# Flask, Paste and the application itself are imported where needed,
+# so that 'bin/flask-ctl' and other short commands start quickly.
 
 etc = partial(os.path.join, 'parts', 'etc')
 
@@ -25,11 +27,49 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
+_warmed_up = False
+
+
+def warm_up():
+    """Preload data, indexes and compiled templates, return time taken."""
+    global _warmed_up
+    from presence_analyzer import org, utils, views
+    started = time.time()
+    utils.warm_up()
+    if not utils.APP.config.get('DATA_INDEXED'):
+        # indexed mode parses users on demand
+        org.get_columns()
+    views.precompile_templates()
+    _warmed_up = True
+    return time.time() - started
+
+
+def warmed_up():
+    """Tell whether the application has been warmed up in this process."""
+    return _warmed_up
+
+
+def _handle_reload(signum, frame):
+    """Load the next data snapshot in the background and swap it in."""
+    import threading
+    from presence_analyzer import utils
+    threading.Thread(target=utils.reload_snapshot).start()
+
+
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import APP
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm=True):
+    from presence_analyzer.main import APP
+    from presence_analyzer import views  # registers the routes
     APP.config.from_pyfile(abspath(config))
     APP.debug = debug
+    if warm and APP.config.get('WARM_UP', True):
+        warm_up()
+    if not debug:
+        # the pre-forking master replaces it with its own handler
+        try:
+            signal.signal(signal.SIGHUP, _handle_reload)
+        except ValueError:
+            pass  # not in the main thread
     return APP
 
 
@@ -50,17 +90,47 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _reload(dry_run=False):
+    """Send SIGHUP to the server to gracefully reload its data.
+
+    The pre-forking master also replaces its workers.
+    """
+    pid_file = abspath('var', 'log', '.paster.pid')
+    print 'kill -HUP $(cat %s)' % pid_file
+    if dry_run:
+        return
+    with open(pid_file) as pid:
+        os.kill(int(pid.read().strip()), signal.SIGHUP)
+
+
+def _server_url(config):
+    """Base URL of the server configured in paster 'config' file."""
+    from ConfigParser import SafeConfigParser
+    parser = SafeConfigParser()
+    parser.read(abspath(config))
+    host = parser.get('server:main', 'host')
+    if host in ('0.0.0.0', ''):
+        host = '127.0.0.1'
+    return 'http://%s:%s' % (host, parser.get('server:main', 'port'))
+
+
+def _serve(action, debug=False, dry_run=False, prefork=False):
+    """Build paster command from 'action', 'debug' and 'prefork' flags."""
+    if action == 'reload':
+        return _reload(dry_run=dry_run)
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
     argv = ['bin/paster', 'serve', config]
+    if prefork:
+        argv += ['--server-name=prefork']
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
-        argv += ['--reload']
+        # the reloader would orphan the forked workers
+        if not prefork:
+            argv += ['--reload']
     else:
         argv += [action]
     # Print the 'paster' command
@@ -75,25 +145,33 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
+
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|reload|status] [--prefork]
+    def action_serve(action=('a', 'start'), dry_run=False, prefork=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
         configuration file for the server and application.
 
         Options:
-         - 'action' is one of [fg|start|stop|restart|status]
+         - 'action' is one of [fg|start|stop|restart|reload|status]
          - '--dry-run' print the paster command and exit
+         - '--prefork' serve with pre-forked worker processes sharing
+           one listening socket, 'reload' gracefully replaces them
+
+        'reload' loads the next data snapshot while the current one is
+        still served and swaps it in.
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, prefork=prefork)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -105,6 +183,45 @@ def run():
         """Status of the application."""
         _serve('status', dry_run=dry_run)
 
+    # bin/flask-ctl warm
+    def action_warm(debug=False):
+        """Load data and compile templates, report the time it takes."""
+        make_app(config=DEBUG_CFG if debug else DEPLOY_CFG, warm=False)
+        print 'Warmed up in %.2fs' % warm_up()
+
+    # bin/flask-ctl benchmark
+    def action_benchmark(repeat=5):
+        """Time organisation statistics against pure Python references."""
+        from presence_analyzer import org
+        make_app(warm=False)
+        results = org.benchmark(repeat)
+        for name in sorted(results):
+            print '%-40s %.4fs' % (name, results[name])
+
+    # bin/flask-ctl loadtest
+    def action_loadtest(url='', clients=10, requests=1000, seed=0,
+                        debug=False):
+        """Drive a running instance with a mix of API requests.
+
+        User ids and dates of requests are taken from the loaded data,
+        throughput, latency percentiles and error rate are printed
+        as JSON.
+
+        Options:
+         - '--url' base URL, by default the one from the paster config
+         - '--clients' number of concurrent clients
+         - '--requests' total number of requests
+         - '--seed' seed of the request mix, so runs are comparable
+        """
+        import json
+        from presence_analyzer import loadtest, utils
+        make_app(config=DEBUG_CFG if debug else DEPLOY_CFG, warm=False)
+        paths = loadtest.build_paths(utils.get_data(), requests, seed=seed)
+        url = url or _server_url(DEBUG_INI if debug else DEPLOY_INI)
+        result = loadtest.run(url.rstrip('/'), paths, clients)
+        result['url'] = url
+        print json.dumps(result, indent=2, sort_keys=True)
+
     # bin/flask-ctl stop
     def action_stop(dry_run=False):
         """Stop the application."""
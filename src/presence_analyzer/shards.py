@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data split into period shards.
+
+DATA_CSV may name a single file, a directory of CSV files or a glob
+pattern. Each file is a shard, such as one month of presence. Loaded
+shards are kept and parsed again only when their file changes, so a
+reload of the data parses only changed shards.
+"""
+
+import glob
+import logging
+import os
+
+from collections import OrderedDict
+from threading import RLock
+
+LOG = logging.getLogger(__name__)
+
+
+class Shard(object):
+    """
+    Loaded presence data of one shard file.
+    """
+    __slots__ = ('path', 'signature', 'data', 'rows', 'rejected')
+
+    def __init__(self, path, signature, data, rows, rejected):
+        self.path = path
+        self.signature = signature
+        self.data = data
+        self.rows = rows
+        self.rejected = rejected
+
+
+def signature(path):
+    """
+    Stat signature telling whether a file has changed.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class ShardSet(object):
+    """
+    Shards of a pattern, each loaded once and again when its file changes.
+
+    'loader' parses a file into (data, rows, rejected).
+    """
+
+    def __init__(self, pattern, loader):
+        self.pattern = pattern
+        self.loader = loader
+        self.loaded = OrderedDict()
+        self.lock = RLock()
+
+    def paths(self):
+        """
+        Sorted paths of all shard files.
+        """
+        if os.path.isdir(self.pattern):
+            return sorted(
+                os.path.join(self.pattern, name)
+                for name in os.listdir(self.pattern)
+                if name.endswith('.csv')
+            )
+        if glob.has_magic(self.pattern):
+            return sorted(glob.glob(self.pattern))
+        return [self.pattern]
+
+    def get(self, path):
+        """
+        Loaded shard, parsed again when its file has changed.
+        """
+        with self.lock:
+            current = signature(path)
+            shard = self.loaded.get(path)
+            if shard is not None and shard.signature == current:
+                return shard
+            LOG.debug('Loading shard %s.', path)
+            data, rows, rejected = self.loader(path)
+            shard = self.loaded[path] = Shard(
+                path, current, data, rows, rejected
+            )
+            return shard
+
+    def get_all(self):
+        """
+        All shards in order of their paths. Shards of files which are
+        gone are forgotten.
+        """
+        with self.lock:
+            paths = self.paths()
+            for path in set(self.loaded) - set(paths):
+                del self.loaded[path]
+            return [self.get(path) for path in paths]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of times of day.
+
+Times are seconds since midnight, so they are counted in fixed width
+buckets over the day. Memory is bounded by the number of buckets in a day
+no matter how many samples are added, quantiles are accurate to half
+of the bucket width and sketches merge exactly by adding their counts.
+"""
+
+from array import array
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class QuantileSketch(object):
+    """
+    Quantile sketch of times of day in buckets of 'resolution' seconds.
+
+    Counts are kept in a compact array spanning buckets from the earliest
+    to the latest sample.
+    """
+    __slots__ = ('resolution', 'offset', 'counts', 'total')
+
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self.offset = 0
+        self.counts = array('I')
+        self.total = 0
+
+    def _extend(self, first, last):
+        """
+        Makes counts span buckets from first to last.
+        """
+        if not self.counts:
+            self.offset = first
+            self.counts.extend([0] * (last - first + 1))
+            return
+        if first < self.offset:
+            self.counts = array('I', [0] * (self.offset - first)) + self.counts
+            self.offset = first
+        end = self.offset + len(self.counts)
+        if last >= end:
+            self.counts.extend([0] * (last - end + 1))
+
+    def add(self, value):
+        """
+        Counts one sample.
+        """
+        bucket = value // self.resolution
+        self._extend(bucket, bucket)
+        self.counts[bucket - self.offset] += 1
+        self.total += 1
+
+    def merge(self, other):
+        """
+        Adds counts of other sketch of the same resolution.
+        """
+        if other.resolution != self.resolution:
+            raise ValueError('Sketches of different resolutions.')
+        if not other.total:
+            return self
+        self._extend(other.offset, other.offset + len(other.counts) - 1)
+        shift = other.offset - self.offset
+        for i, count in enumerate(other.counts):
+            self.counts[shift + i] += count
+        self.total += other.total
+        return self
+
+    def percentiles(self, percents):
+        """
+        Nearest-rank percentiles for sorted integer percents, zeros when
+        the sketch is empty.
+        """
+        if not self.total:
+            return [0] * len(percents)
+        result = []
+        seen = 0
+        buckets = enumerate(self.counts, self.offset)
+        bucket = None
+        for percent in percents:
+            rank = max(1, -(-percent * self.total // 100))
+            while seen < rank:
+                bucket, count = next(buckets)
+                seen += count
+            result.append(min(
+                bucket * self.resolution + self.resolution // 2,
+                SECONDS_PER_DAY - 1
+            ))
+        return result
+
+    def percentile(self, percent):
+        """
+        Nearest-rank percentile, zero when the sketch is empty.
+        """
+        return self.percentiles([percent])[0]
@@ -7,13 +7,25 @@ from __future__ import unicode_literals
 
 import datetime
 import json
+import multiprocessing
 import os.path
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
-from mock import Mock
+from flask_mako import _lookup
+from functools import partial
+from mock import Mock, patch
+from werkzeug.serving import make_server
 
 from presence_analyzer import (  # pylint: disable=unused-import
-    main, utils, views
+    cache, export, index, loadtest, main, org, prefork, shards, sketches,
+    utils, views
 )
 
 TEST_DATA_CSV = os.path.join(
@@ -22,6 +34,13 @@ TEST_DATA_CSV = os.path.join(
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_xml.xml'
 )
+TEST_DATA_ERRORS_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'test_data_errors.csv'
+)
+TEST_SHARDS_DIR = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_shards'
+)
 DELETED_XML_FILE = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'deleted_xml.xml'
 )
@@ -133,6 +152,63 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_user_summary_view(self):
+        """
+        Test per-user statistics returned in one document.
+        """
+        resp = self.client.get('/api/v1/user_summary/1')
+        self.assertEqual(resp.status_code, 404)
+        directory = {10: {'user_id': 10, 'name': 'Jan K.', 'avatar': 'a'}}
+        with patch.object(views, 'get_user_directory') as get_directory:
+            get_directory.return_value = directory
+            resp = self.client.get('/api/v1/user_summary/10')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/json')
+            summary = json.loads(resp.data)
+            get_directory.side_effect = IOError
+            unknown = json.loads(
+                self.client.get('/api/v1/user_summary/11').data
+            )
+        self.assertEqual(summary['user_id'], 10)
+        self.assertEqual(summary['name'], 'Jan K.')
+        self.assertEqual(summary['avatar'], 'a')
+        for name in (
+                'presence_weekday', 'mean_time_weekday',
+                'presence_start_end'):
+            self.assertListEqual(
+                summary[name],
+                json.loads(self.client.get('/api/v1/%s/10' % name).data)
+            )
+        self.assertIsNone(unknown['name'])
+        self.assertListEqual(
+            unknown['presence_start_end'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data)
+        )
+
+    def test_rollup_view(self):
+        """
+        Test weekly and monthly rollups of user's presence.
+        """
+        resp = self.client.get('/api/v1/rollup/week/1')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/rollup/year/10')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/rollup/week/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertListEqual(
+            json.loads(resp.data),
+            [
+                ['2013-W36', 1, 22999, 34088.0, 57087.0],
+                ['2013-W37', 5, 95403, 36972.4, 56053.0],
+            ]
+        )
+        resp = self.client.get('/api/v1/rollup/month/10')
+        self.assertListEqual(
+            json.loads(resp.data),
+            [['2013-09', 3, 78217, 35754.333333333336, 61826.666666666664]]
+        )
+
     def test_mean_presence_hours_view(self):
         """
         Test mean presence time view.
@@ -167,6 +243,54 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content_type, 'text/html; charset=utf-8')
 
+    def test_render_template_unknown_page(self):
+        """
+        Test that unknown pages are rejected without template lookups.
+        """
+        views.precompile_templates()
+        lookup = _lookup(main.APP)  # pylint: disable=protected-access
+        with patch.object(lookup, 'get_template') as get_template:
+            response = self.client.get('/random_crawler_path')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(get_template.called)
+
+    def test_render_template_cache(self):
+        """
+        Test that rendered pages are cached and conditionally served.
+        """
+        views.precompile_templates()
+        response = self.client.get('/mean_time_weekday')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        self.assertIn(('mean_time_weekday', ''), views.PAGE_CACHE)
+        with patch.object(views, 'render_template') as render:
+            response = self.client.get('/mean_time_weekday')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['ETag'], etag)
+            response = self.client.get(
+                '/mean_time_weekday',
+                headers={'If-None-Match': etag}
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse(render.called)
+
+    def test_precompile_templates(self):
+        """
+        Test that all templates are compiled and broken ones are skipped.
+        """
+        # pylint: disable=protected-access
+        lookup = _lookup(main.APP)
+        with patch.object(
+            lookup, 'get_template', wraps=lookup.get_template
+        ) as get_template:
+            views.precompile_templates()
+        compiled = [args[0] for args, _ in get_template.call_args_list]
+        self.assertIn('presence_weekday.html', compiled)
+        self.assertIn('test_template.html', compiled)
+        self.assertIn('presence_weekday.html', lookup._collection)
+        self.assertNotIn('test_template.html', lookup._collection)
+
     def test_view_all_days(self):
         """
         Test for getting all unique dates and its datecodes from data.
@@ -186,6 +310,137 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_presence_distribution_view(self):
+        """
+        Test percentiles of presence start and end of given user.
+        """
+        response = self.client.get('/api/v1/presence_distribution/1')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/v1/presence_distribution/11')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        distribution = json.loads(response.data)
+        self.assertEqual(len(distribution), 8)
+        self.assertDictEqual(
+            distribution[0],
+            {
+                'weekday': 'Mon',
+                'count': 1,
+                'start': {'p10': 33150, 'p50': 33150, 'p90': 33150},
+                'end': {'p10': 57270, 'p50': 57270, 'p90': 57270},
+            }
+        )
+        self.assertEqual(distribution[-1]['weekday'], 'All')
+        self.assertEqual(distribution[-1]['count'], 6)
+        self.assertEqual(distribution[5]['start']['p50'], 0)
+
+    def test_view_all_days_paginated(self):
+        """
+        Test for paginated and streamed dates listing.
+        """
+        response = self.client.get('/api/v1/days/?limit=4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Next-Cursor'], '4')
+        self.assertListEqual(
+            json.loads(response.data),
+            [
+                [130905, '05.09.13'],
+                [130909, '09.09.13'],
+                [130910, '10.09.13'],
+                [130911, '11.09.13']
+            ]
+        )
+        response = self.client.get('/api/v1/days/?cursor=4&limit=4')
+        self.assertNotIn('X-Next-Cursor', response.headers)
+        self.assertListEqual(
+            json.loads(response.data),
+            [[130912, '12.09.13'], [130913, '13.09.13']]
+        )
+        response = self.client.get('/api/v1/days/?cursor=1&stream=1')
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(len(json.loads(response.data)), 5)
+        with patch.object(utils, 'iter_json') as iter_json:
+            response = self.client.get('/api/v1/days/?stream=0&limit=2')
+            self.assertFalse(iter_json.called)
+        self.assertEqual(len(json.loads(response.data)), 2)
+        response = self.client.get('/api/v1/days/?stream=maybe')
+        self.assertEqual(response.status_code, 400)
+        with patch.object(utils, 'get_all_days') as get_all_days:
+            self.client.get('/api/v1/days/?cursor=2&limit=2')
+            self.assertFalse(get_all_days.called)
+        response = self.client.get('/api/v1/days/?limit=0')
+        self.assertEqual(response.status_code, 400)
+
+    def test_view_all_days_empty(self):
+        """
+        Test that an empty listing is not a bad request.
+        """
+        with patch.object(views, 'get_days_listing', return_value=[]):
+            for query in ('', '?stream=1', '?cursor=0'):
+                response = self.client.get('/api/v1/days/' + query)
+                self.assertEqual(response.status_code, 200)
+                self.assertListEqual(json.loads(response.data), [])
+                self.assertNotIn('X-Next-Cursor', response.headers)
+            response = self.client.get('/api/v1/days/?limit=0')
+            self.assertEqual(response.status_code, 400)
+
+    def test_api_users_paginated(self):
+        """
+        Test for paginated users listing.
+        """
+        response = self.client.get('/api/v1/users?cursor=2&limit=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Next-Cursor'], '5')
+        page = json.loads(response.data)
+        self.assertEqual(len(page), 3)
+        response = self.client.get('/api/v1/users?stream=1')
+        self.assertListEqual(
+            json.loads(response.data)[2:5],
+            page
+        )
+
+    def test_stats_view(self):
+        """
+        Test for ingestion and cache counters.
+        """
+        response = self.client.get('/api/v1/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        stats = json.loads(response.data)
+        self.assertItemsEqual(stats.keys(), ['version', 'ingestion', 'cache'])
+        self.assertEqual(
+            response.headers['X-Data-Version'],
+            str(stats['version'])
+        )
+        self.assertItemsEqual(
+            stats['cache'].keys(),
+            ['hits', 'shared_hits', 'misses', 'invalidated']
+        )
+
+    def test_org_views(self):
+        """
+        Test for organisation-wide statistics.
+        """
+        response = self.client.get('/api/v1/org/mean_start_end')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertListEqual(
+            json.loads(response.data)[:2],
+            [['Mon', 33134.0, 57257.0], ['Tue', 34167.5, 57473.0]]
+        )
+        response = self.client.get('/api/v1/org/headcount?limit=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(
+            json.loads(response.data),
+            [['2013-09-05', 1], ['2013-09-09', 1], ['2013-09-10', 2]]
+        )
+        response = self.client.get('/api/v1/org/monthly_presence')
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(
+            json.loads(response.data),
+            [['2013-09', 196619 / 9.0, 9]]
+        )
+
     def test_view_top_five_employees(self):
         """
         Test for getting all ids and worked time of employees
@@ -198,6 +453,47 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(response.content_type, 'application/json')
         self.assertListEqual(json.loads(response.data), [[11, 24123]])
 
+    def test_view_top_employees(self):
+        """
+        Test for getting top employees joined with the users directory.
+        """
+        directory = {
+            10: {'user_id': 10, 'name': 'Adam P.', 'avatar': 'a10'},
+            11: {'user_id': 11, 'name': 'Artur L.', 'avatar': 'a11'},
+        }
+        response = self.client.get('/api/v1/top_employees/130901')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/v1/top_employees/130910?limit=0')
+        self.assertEqual(response.status_code, 400)
+        with patch.object(views, 'get_user_directory') as get_directory:
+            get_directory.return_value = directory
+            response = self.client.get('/api/v1/top_employees/130910')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content_type, 'application/json')
+            self.assertListEqual(
+                json.loads(response.data),
+                [
+                    {
+                        'user_id': 10,
+                        'name': 'Adam P.',
+                        'avatar': 'a10',
+                        'presence': 30047
+                    },
+                    {
+                        'user_id': 11,
+                        'name': 'Artur L.',
+                        'avatar': 'a11',
+                        'presence': 16564
+                    },
+                ]
+            )
+            response = self.client.get(
+                '/api/v1/top_employees/130910?limit=1'
+            )
+            self.assertEqual(len(json.loads(response.data)), 1)
+        response = self.client.get('/api/v1/top_employees/130910')
+        self.assertListEqual(json.loads(response.data), [])
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -209,6 +505,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Before each test, set up a environment.
         """
         main.APP.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.APP.config.update({'DATA_XML': TEST_DATA_XML})
 
     def tearDown(self):
         """
@@ -226,15 +523,204 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertListEqual(test_data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, test_data[10])
+        self.assertEqual(
+            test_data[10][sample_date],
+            utils.Presence(sample_date.toordinal(), 34745, 64792)
+        )
+        self.assertEqual(test_data[10][sample_date].duration, 30047)
+        interned = [
+            day for day in test_data[11] if day == sample_date
+        ][0]
+        self.assertIs(
+            [day for day in test_data[10] if day == sample_date][0],
+            interned
+        )
+
+    def test_get_data_rejected_rows(self):
+        """
+        Test that invalid rows are counted, quarantined and never merged.
+        """
+        temp_dir = tempfile.mkdtemp()
+        quarantine_file = os.path.join(temp_dir, 'quarantine.csv')
+        main.APP.config.update({
+            'DATA_CSV': TEST_DATA_ERRORS_CSV,
+            'DATA_QUARANTINE': quarantine_file,
+        })
+        utils.CACHE_STORAGE = {}
+        try:
+            with patch.object(utils.LOG, 'warning') as warning:
+                data = utils.get_data()
+                with open(quarantine_file) as rejected:
+                    rejected_rows = rejected.read().splitlines()
+                os.remove(quarantine_file)
+                utils.reload_snapshot()
+            # unchanged file isn't parsed, logged or quarantined again
+            self.assertEqual(warning.call_count, 1)
+            self.assertFalse(os.path.exists(quarantine_file))
+        finally:
+            main.APP.config.update({
+                'DATA_CSV': TEST_DATA_CSV,
+                'DATA_QUARANTINE': None,
+            })
+            utils.CACHE_STORAGE = {}
+            shutil.rmtree(temp_dir)
+
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertItemsEqual(
+            data[10].keys(),
+            [datetime.date(2013, 9, 10)]
+        )
         self.assertItemsEqual(
-            test_data[10][sample_date].keys(),
-            ['start', 'end']
+            data[11].keys(),
+            [datetime.date(2013, 9, 11)]
+        )
+        self.assertDictEqual(
+            utils.INGESTION_STATS['rejected'],
+            {'columns': 1, 'user_id': 1, 'date': 1, 'time': 1, 'interval': 1}
         )
+        self.assertEqual(utils.INGESTION_STATS['rows'], 7)
+        self.assertEqual(utils.INGESTION_STATS['accepted'], 2)
+        self.assertEqual(len(rejected_rows), 5)
         self.assertEqual(
-            test_data[10][sample_date]['start'],
-            datetime.time(9, 39, 5)
+            rejected_rows[0],
+            'test_data_errors.csv,3,user_id,'
+            'x1,2013-09-11,09:19:52,16:07:37'
         )
 
+    def test_load_csv_header(self):
+        """
+        Test that the header and blank lines are skipped without counting.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'presence.csv')
+        try:
+            with open(path, 'w') as csv_file:
+                csv_file.write(
+                    'user_id,date,start,end\n'
+                    '10,2013-09-10,09:39:05,17:59:52\n'
+                    '\n'
+                )
+            data, rows, rejected = utils.load_csv(path)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertEqual(rows, 1)
+        self.assertListEqual(rejected, [])
+
+    def test_get_data_shards(self):
+        """
+        Test that shards of a directory or glob pattern are merged.
+        """
+        for pattern in (
+                TEST_SHARDS_DIR,
+                os.path.join(TEST_SHARDS_DIR, 'presence-*.csv')):
+            main.APP.config.update({'DATA_CSV': pattern})
+            utils.CACHE_STORAGE = {}
+            data = utils.get_data()
+            self.assertItemsEqual(data.keys(), [10, 11, 12])
+            self.assertItemsEqual(
+                data[10].keys(),
+                [
+                    datetime.date(2013, 8, 29),
+                    datetime.date(2013, 8, 30),
+                    datetime.date(2013, 9, 2),
+                ]
+            )
+            self.assertEqual(utils.INGESTION_STATS['rows'], 6)
+        utils.CACHE_STORAGE = {}
+
+    def test_get_day_data(self):
+        """
+        Test that presence at a day is read from the snapshot and rebuilt
+        only for changed dates.
+        """
+        main.APP.config.update({'DATA_CSV': TEST_SHARDS_DIR})
+        data = utils.get_data()
+        days = utils.get_snapshot().days
+        day_data = utils.get_day_data(datetime.date(2013, 9, 2))
+        self.assertItemsEqual(day_data.keys(), [10, 11])
+        self.assertEqual(day_data[11].duration, 14400)
+        self.assertEqual(utils.get_day_data(datetime.date(2013, 10, 1)), {})
+
+        day = datetime.date(2013, 9, 20)
+        changed = dict(data)
+        changed[10] = dict(data[10])
+        changed[10][day] = utils.Presence(day.toordinal(), 0, 28800)
+        del changed[12]
+        try:
+            snapshot = utils.publish_snapshot(changed)
+            self.assertEqual(
+                utils.get_day_data(day),
+                {10: changed[10][day]}
+            )
+            self.assertIn(130920, utils.get_all_days())
+            self.assertNotIn(datetime.date(2013, 9, 3), snapshot.days)
+            self.assertIs(
+                snapshot.days[datetime.date(2013, 9, 2)],
+                days[datetime.date(2013, 9, 2)]
+            )
+            with main.APP.test_client() as client:
+                response = client.get('/api/v1/top_five/130920')
+                self.assertEqual(json.loads(response.data), [[10, 28800]])
+                self.assertEqual(
+                    response.headers['X-Data-Version'],
+                    str(snapshot.version)
+                )
+        finally:
+            utils.publish_snapshot(data)
+        self.assertNotIn(day, utils.get_snapshot().days)
+        self.assertNotIn(130920, utils.get_all_days())
+
+    def test_shards_reused(self):
+        """
+        Test that unchanged shards are not parsed again by reloads.
+        """
+        main.APP.config.update({'DATA_CSV': TEST_SHARDS_DIR})
+        loader = Mock(side_effect=utils.load_csv)
+        shard_set = shards.ShardSet(TEST_SHARDS_DIR, loader)
+        with patch.object(utils, 'get_shards', return_value=shard_set):
+            for _ in xrange(3):
+                utils.reload_snapshot()
+        self.assertEqual(loader.call_count, 2)
+        self.assertItemsEqual(shard_set.loaded.keys(), shard_set.paths())
+
+    def test_shards_reload(self):
+        """
+        Test that a changed shard is parsed again and a removed one is
+        forgotten.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'presence-2013-09.csv')
+        other = os.path.join(temp_dir, 'presence-2013-10.csv')
+        try:
+            for shard_path in (path, other):
+                with open(shard_path, 'w') as shard_file:
+                    shard_file.write('10,2013-09-02,09:15:00,17:15:00\n')
+            shard_set = shards.ShardSet(temp_dir, utils.load_csv)
+            first = shard_set.get_all()[0]
+            self.assertIs(shard_set.get(path), first)
+            with open(path, 'a') as shard_file:
+                shard_file.write('11,2013-09-02,08:00:00,12:00:00\n')
+            os.remove(other)
+            reloaded = shard_set.get_all()
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(len(reloaded), 1)
+        self.assertIsNot(reloaded[0], first)
+        self.assertItemsEqual(reloaded[0].data.keys(), [10, 11])
+        self.assertListEqual(shard_set.loaded.keys(), [path])
+
+    def test_parse_time(self):
+        """
+        Test for parsing time into seconds since midnight.
+        """
+        self.assertEqual(utils.parse_time('00:00:00'), 0)
+        self.assertEqual(utils.parse_time('09:39:05'), 34745)
+        self.assertEqual(utils.parse_time('23:59:59'), 86399)
+        self.assertRaises(ValueError, utils.parse_time, '24:00:00')
+        self.assertRaises(ValueError, utils.parse_time, '12:60')
+        self.assertRaises(ValueError, utils.parse_time, 'ab:cd:ef')
+
     def test_group_by_weekday(self):
         """
         Test for grouped presence entries by weekday.
@@ -341,6 +827,1059 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(len(data), 1)
         self.assertDictEqual(data, {11: 6426})
 
+    def test_iter_json(self):
+        """
+        Test for chunked JSON serialization of lists.
+        """
+        self.assertEqual(''.join(utils.iter_json([])), '[]')
+        items = [{'id': i} for i in xrange(3000)]
+        chunks = list(utils.iter_json(iter(items)))
+        self.assertGreater(len(chunks), 1)
+        self.assertListEqual(json.loads(''.join(chunks)), items)
+
+    def test_changed_rows(self):
+        """
+        Test for finding users and dates of changed rows.
+        """
+        day = datetime.date(2013, 9, 10)
+        other_day = datetime.date(2013, 9, 11)
+        old_data = {
+            10: {day: utils.Presence(day.toordinal(), 1, 2)},
+            11: {day: utils.Presence(day.toordinal(), 3, 4)},
+        }
+        new_data = {
+            10: {day: utils.Presence(day.toordinal(), 1, 2)},
+            11: {day: utils.Presence(day.toordinal(), 3, 5)},
+            12: {other_day: utils.Presence(other_day.toordinal(), 1, 2)},
+        }
+        users, dates = utils.changed_rows(old_data, new_data)
+        self.assertItemsEqual(users, [11, 12])
+        self.assertItemsEqual(dates, [day, other_day])
+        self.assertEqual(
+            utils.changed_rows(old_data, old_data),
+            (set(), set())
+        )
+
+    def test_rollups_incremental(self):
+        """
+        Test that rollups are rebuilt only for users with changed rows.
+        """
+        data = utils.get_data()
+        rollups = utils.get_snapshot().rollups
+        self.assertEqual(rollups[10]['week']['2013-W37'][0], 3)
+        day = datetime.date(2013, 9, 16)
+        changed = dict(data)
+        changed[10] = dict(data[10])
+        changed[10][day] = utils.Presence(day.toordinal(), 0, 100)
+        try:
+            snapshot = utils.publish_snapshot(changed)
+            self.assertIsNot(snapshot.rollups, rollups)
+            self.assertIs(snapshot.rollups[11], rollups[11])
+            self.assertListEqual(
+                snapshot.rollups[10]['week']['2013-W38'],
+                [1, 100, 0, 100]
+            )
+            self.assertListEqual(
+                snapshot.rollups[10]['month']['2013-09'],
+                [4, 78317, 107263, 185580]
+            )
+            self.assertEqual(
+                len(utils.get_rollup(10, 'week')),
+                2
+            )
+        finally:
+            utils.publish_snapshot(data)
+        self.assertIs(utils.get_snapshot().rollups[11], rollups[11])
+        self.assertEqual(len(utils.get_rollup(10, 'week')), 1)
+
+    def test_depends_on(self):
+        """
+        Test that refreshed data invalidates only dependent results.
+        """
+        utils.CACHE_STORAGE = {}
+        data = utils.get_data()
+        self.assertEqual(utils.get_user_weekdays(10)[1], [30047])
+        utils.get_user_weekdays(11)
+        utils.get_employees('130910')
+        utils.get_employees('130913')
+        utils.get_all_days()
+        hits = utils.CACHE_STATS['hits']
+        utils.get_user_weekdays(10)
+        self.assertEqual(utils.CACHE_STATS['hits'], hits + 1)
+
+        day = datetime.date(2013, 9, 10)
+        changed = dict(data)
+        changed[10] = dict(data[10])
+        changed[10][day] = utils.Presence(day.toordinal(), 0, 100)
+        version = utils.LOADED['version']
+        utils.publish_snapshot(changed)
+        self.assertEqual(utils.LOADED['version'], version + 1)
+        cached = utils.CACHE_STORAGE.keys()
+        self.assertIn("get_user_weekdays['11'][]", cached)
+        self.assertIn("get_employees['130913'][]", cached)
+        self.assertNotIn("get_user_weekdays['10'][]", cached)
+        self.assertNotIn("get_employees['130910'][]", cached)
+        self.assertNotIn('get_all_days[][]', cached)
+
+        utils.publish_snapshot(data)
+        self.assertEqual(utils.get_user_weekdays(10)[1], [30047])
+
+    def test_snapshot_per_request(self):
+        """
+        Test that a request reads one snapshot even when it's replaced.
+        """
+        utils.CACHE_STORAGE = {}
+        data = utils.get_data()
+        changed = dict(data)
+        del changed[10]
+        try:
+            with main.APP.test_request_context('/api/v1/rollup/week/10'):
+                snapshot = utils.get_snapshot()
+                self.assertIsNotNone(utils.get_user_data(10))
+                utils.publish_snapshot(changed)
+                self.assertIs(utils.get_snapshot(), snapshot)
+                self.assertEqual(utils.get_user_weekdays(10)[1], [30047])
+                self.assertEqual(len(utils.get_rollup(10, 'week')), 1)
+                response = main.APP.process_response(main.APP.response_class())
+                self.assertEqual(
+                    response.headers['X-Data-Version'],
+                    str(snapshot.version)
+                )
+            self.assertNotIn(
+                "get_user_weekdays['10'][]", utils.CACHE_STORAGE
+            )
+            self.assertIsNone(utils.get_user_data(10))
+        finally:
+            utils.publish_snapshot(data)
+
+    def test_refresh_users(self):
+        """
+        Test that refreshed users don't change the version of snapshots.
+        """
+        utils.get_user_weekdays(10)
+        version = utils.LOADED['version']
+        generation = utils.LOADED['generation']
+        utils.refresh_users([10])
+        self.assertEqual(utils.LOADED['version'], version)
+        self.assertEqual(utils.LOADED['generation'], generation + 1)
+        self.assertNotIn("get_user_weekdays['10'][]", utils.CACHE_STORAGE)
+
+    def test_get_top_employees(self):
+        """
+        Test for top employees of certain date joined with their names.
+        """
+        directory = {11: {'user_id': 11, 'name': 'Artur L.', 'avatar': 'a'}}
+        self.assertListEqual(
+            utils.get_top_employees('130910', directory),
+            [{'user_id': 11, 'name': 'Artur L.', 'avatar': 'a',
+              'presence': 16564}]
+        )
+        self.assertListEqual(utils.get_top_employees('130910', {}), [])
+
+    def test_get_user_directory(self):
+        """
+        Test for users from XML file by their ids.
+        """
+        directory = utils.get_user_directory(TEST_DATA_XML)
+        self.assertEqual(len(directory), 6)
+        self.assertEqual(directory[15]['name'], 'Wojciech L.')
+
+    def test_get_users_changed_file(self):
+        """
+        Test that users are parsed again when the XML file changes.
+        """
+        temp_dir = tempfile.mkdtemp()
+        xml_file = os.path.join(temp_dir, 'users.xml')
+        try:
+            shutil.copy(TEST_DATA_XML, xml_file)
+            self.assertEqual(len(utils.get_user_directory(xml_file)), 6)
+            with open(xml_file) as source:
+                content = source.read()
+            start = content.index(b'<user id="15">')
+            end = content.index(b'</user>', start) + len(b'</user>')
+            with open(xml_file, 'w') as target:
+                target.write(content[:start] + content[end:])
+            os.utime(xml_file, (0, 0))
+            directory = utils.get_user_directory(xml_file)
+            users = utils.get_users(xml_file)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(len(directory), 5)
+        self.assertNotIn(15, directory)
+        self.assertEqual(len(users), 5)
+
+    def test_warm_up(self):
+        """
+        Test that warm up loads presence data into the cache.
+        """
+        utils.CACHE_STORAGE = {}
+        snapshot = utils.get_snapshot()
+        utils.warm_up()
+        self.assertIsNot(utils.LOADED['snapshot'], snapshot)
+        self.assertItemsEqual(utils.LOADED['snapshot'].data.keys(), [10, 11])
+        self.assertIn('get_all_days[][]', utils.CACHE_STORAGE)
+        self.assertIn('get_days_listing[][]', utils.CACHE_STORAGE)
+
+    def test_get_snapshot(self):
+        """
+        Test that snapshots are swapped in and read without waiting.
+        """
+        snapshot = utils.get_snapshot()
+        self.assertIs(utils.get_snapshot(), snapshot)
+        self.assertIs(utils.get_data(), snapshot.data)
+        self.assertEqual(snapshot.version, utils.LOADED['version'])
+
+        main.APP.config.update({'DATA_TTL': 0})
+        try:
+            with utils.RELOAD_LOCK:
+                # another thread is reloading, the old snapshot is served
+                self.assertIs(utils.get_snapshot(), snapshot)
+            reloaded = utils.get_snapshot()
+        finally:
+            del main.APP.config['DATA_TTL']
+        self.assertIsNot(reloaded, snapshot)
+        self.assertIs(reloaded.data, snapshot.data)
+        self.assertEqual(reloaded.version, snapshot.version)
+
+        main.APP.config.update({'DATA_CSV': TEST_DATA_ERRORS_CSV})
+        other = utils.get_snapshot()
+        self.assertEqual(other.version, snapshot.version + 1)
+        self.assertEqual(other.pattern, TEST_DATA_ERRORS_CSV)
+        self.assertItemsEqual(snapshot.data[11].keys(), [
+            datetime.date(2013, 9, day) for day in (5, 9, 10, 11, 12, 13)
+        ])
+
+
+class PresenceAnalyzerIndexTestCase(unittest.TestCase):
+    """
+    Byte-offset index tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.temp_dir, 'presence.csv')
+        shutil.copy(TEST_DATA_CSV, self.csv_file)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.APP.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_INDEXED': False,
+        })
+        utils.CACHE_STORAGE = {}
+        utils.LOADED['indexes'].clear()
+        shutil.rmtree(self.temp_dir)
+
+    def test_build_index(self):
+        """
+        Test byte ranges of users' rows.
+        """
+        with open(self.csv_file, 'w') as csv_file:
+            csv_file.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '11,2013-09-10,09:19:50,13:55:54\n'
+                '11,2013-09-11,09:13:26,16:15:27\n'
+                '10,2013-09-11,09:19:52,16:07:37\n'
+                '11,2013-09-12,17:00:00,09:00:00\n'
+            )
+        ranges, rows, rejected = index.build_index(
+            self.csv_file, partial(utils.validate_line, dates={})
+        )
+        self.assertDictEqual(
+            ranges,
+            {10: [[23, 55], [119, 151]], 11: [[55, 119], [151, 183]]}
+        )
+        self.assertEqual(rows, 5)
+        self.assertListEqual(
+            rejected,
+            [[6, 'interval', '11', '2013-09-12', '17:00:00', '09:00:00']]
+        )
+        user_index = index.UserIndex(self.csv_file, utils.parse_rows, 10)
+        self.assertListEqual(
+            user_index.read(ranges[10]),
+            [
+                '10,2013-09-10,09:39:05,17:59:52',
+                '10,2013-09-11,09:19:52,16:07:37',
+            ]
+        )
+
+    def test_load_index(self):
+        """
+        Test that the sidecar index is reused until the CSV changes.
+        """
+        current = shards.signature(self.csv_file)
+        loaded = index.load_index(self.csv_file, current)
+        self.assertTrue(os.path.exists(index.index_path(self.csv_file)))
+        with patch.object(index, 'build_index') as build_index:
+            build_index.return_value = ({}, 0, [])
+            self.assertEqual(
+                index.load_index(self.csv_file, current),
+                loaded
+            )
+            self.assertFalse(build_index.called)
+            index.load_index(self.csv_file, (0, 0))
+            build_index.assert_called_once_with(self.csv_file, None)
+
+    def test_user_index(self):
+        """
+        Test parsing users on demand, LRU of them and reloads.
+        """
+        parse = Mock(side_effect=utils.parse_rows)
+        on_reload = Mock()
+        user_index = index.UserIndex(self.csv_file, parse, 1, on_reload)
+        self.assertListEqual(user_index.user_ids(), [10, 11])
+        days = user_index.get(10)
+        self.assertEqual(len(days), 3)
+        self.assertEqual(
+            days[datetime.date(2013, 9, 10)].duration,
+            30047
+        )
+        self.assertEqual(len(parse.call_args[0][0]), 3)
+        self.assertIs(user_index.get(10), days)
+        self.assertIsNone(user_index.get(12))
+        user_index.get(11)
+        self.assertListEqual(user_index.parsed.keys(), [11])
+        self.assertEqual(parse.call_count, 2)
+        self.assertFalse(on_reload.called)
+
+        with open(self.csv_file, 'a') as csv_file:
+            csv_file.write('\n12,2013-09-13,09:00:00,17:00:00\n')
+        os.utime(self.csv_file, (0, 0))
+        self.assertEqual(len(user_index.get(12)), 1)
+        on_reload.assert_called_once_with(set([11, 12]))
+        self.assertIsNot(user_index.get(10), days)
+
+    def test_indexed_views(self):
+        """
+        Test that per-user views in indexed mode don't load all data.
+        """
+        main.APP.config.update({
+            'DATA_CSV': self.csv_file,
+            'DATA_INDEXED': True,
+        })
+        utils.CACHE_STORAGE = {}
+        client = main.APP.test_client()
+        with patch.object(utils, 'get_data') as get_data:
+            response = client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(response.status_code, 200)
+            self.assertListEqual(
+                json.loads(response.data)[1:4],
+                [['Mon', 0], ['Tue', 30047], ['Wed', 24465]]
+            )
+            response = client.get('/api/v1/presence_distribution/11')
+            self.assertEqual(response.status_code, 200)
+            response = client.get('/api/v1/rollup/month/11')
+            self.assertListEqual(
+                json.loads(response.data)[0][:3],
+                ['2013-09', 6, 118402]
+            )
+            response = client.get('/api/v1/mean_time_weekday/12')
+            self.assertEqual(response.status_code, 404)
+            self.assertFalse(get_data.called)
+
+        with open(self.csv_file, 'a') as csv_file:
+            csv_file.write('\n10,2013-09-16,09:00:00,17:00:00\n')
+        os.utime(self.csv_file, (0, 0))
+        response = client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(json.loads(response.data)[1], ['Mon', 28800])
+
+    def test_user_index_parse_unlocked(self):
+        """
+        Test that users are parsed without holding the lock of the index.
+        """
+        locked = []
+
+        def parse(lines):
+            """
+            Tells whether another thread can take the lock meanwhile.
+            """
+            def try_lock():
+                """
+                Takes and releases the lock if it's free.
+                """
+                if user_index.lock.acquire(False):
+                    user_index.lock.release()
+                    locked.append(False)
+                else:
+                    locked.append(True)
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            return utils.parse_rows(lines)
+
+        user_index = index.UserIndex(self.csv_file, parse, 10)
+        self.assertEqual(len(user_index.get(10)), 3)
+        self.assertListEqual(locked, [False])
+        self.assertListEqual(user_index.parsed.keys(), [10])
+
+    def test_indexed_rejected_rows(self):
+        """
+        Test that rows rejected in indexed mode are counted and quarantined.
+        """
+        quarantine_file = os.path.join(self.temp_dir, 'quarantine.csv')
+        shutil.copy(TEST_DATA_ERRORS_CSV, self.csv_file)
+        main.APP.config.update({
+            'DATA_CSV': self.csv_file,
+            'DATA_INDEXED': True,
+            'DATA_QUARANTINE': quarantine_file,
+        })
+        try:
+            with patch.object(utils.LOG, 'warning') as warning:
+                response = main.APP.test_client().get(
+                    '/api/v1/presence_weekday/10'
+                )
+                main.APP.test_client().get('/api/v1/presence_weekday/11')
+            self.assertEqual(warning.call_count, 1)
+        finally:
+            main.APP.config.update({'DATA_QUARANTINE': None})
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(
+            utils.INGESTION_STATS['rejected'],
+            {'columns': 1, 'user_id': 1, 'date': 1, 'time': 1, 'interval': 1}
+        )
+        self.assertEqual(utils.INGESTION_STATS['rows'], 7)
+        with open(quarantine_file) as rejected:
+            self.assertEqual(
+                rejected.read().splitlines()[0],
+                'presence.csv,3,user_id,x1,2013-09-11,09:19:52,16:07:37'
+            )
+
+    def test_indexed_invalid_rows(self):
+        """
+        Test that a user with only invalid rows isn't found in indexed mode.
+        """
+        with open(self.csv_file, 'a') as csv_file:
+            csv_file.write(
+                '\n12,2013-09-16,17:00:00,09:00:00'
+                '\n12,2013-13-16,09:00:00,17:00:00\n'
+            )
+        main.APP.config.update({
+            'DATA_CSV': self.csv_file,
+            'DATA_INDEXED': True,
+        })
+        utils.CACHE_STORAGE = {}
+        self.assertIsNone(utils.get_user_data(12))
+        client = main.APP.test_client()
+        for path in (
+                '/api/v1/presence_weekday/12',
+                '/api/v1/user_summary/12',
+                '/api/v1/rollup/week/12'):
+            response = client.get(path)
+            self.assertEqual(response.status_code, 404)
+        main.APP.config.update({'DATA_INDEXED': False})
+        self.assertIsNone(utils.get_user_data(12))
+
+
+def fill_shared_cache(path, worker, keys):
+    """
+    Stores and reads back entries of the shared cache in a child process.
+    """
+    backend = cache.SQLiteCache(path)
+    for i in xrange(keys):
+        backend['shared'] = {'time': i, 'value': [worker, i]}
+        backend['%d-%d' % (worker, i)] = {'time': i, 'value': worker * i}
+        if backend.get('%d-%d' % (worker, i))['value'] != worker * i:
+            os._exit(1)  # pylint: disable=protected-access
+        if backend.get('shared') is None:
+            os._exit(1)  # pylint: disable=protected-access
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, 'cache.sqlite')
+        main.APP.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'CACHE_BACKEND': 'sqlite',
+            'CACHE_FILE': self.cache_file,
+        })
+        utils.CACHE_STORAGE = {}
+        utils.get_data()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.APP.config.update({'CACHE_BACKEND': 'local'})
+        utils.CACHE_STORAGE = {}
+        utils.SHARED_CACHES.clear()
+        shutil.rmtree(self.temp_dir)
+
+    def test_sqlite_cache(self):
+        """
+        Test storing, reading and removing entries of the SQLite cache.
+        """
+        backend = cache.SQLiteCache(self.cache_file)
+        self.assertIsNone(backend.get('key'))
+        backend['key'] = {'time': 1, 'tag': 't', 'value': {'a': [1, 2]}}
+        self.assertDictEqual(
+            cache.SQLiteCache(self.cache_file).get('key'),
+            {'time': 1, 'tag': 't', 'value': {'a': [1, 2]}}
+        )
+        self.assertEqual(backend.pop('key')['value'], {'a': [1, 2]})
+        self.assertIsNone(backend.pop('key'))
+        backend['key'] = {'time': 2, 'value': 'v'}
+        backend.clear()
+        self.assertIsNone(backend.get('key'))
+
+    def test_sqlite_cache_broken(self):
+        """
+        Test that errors of the cache file are treated as misses.
+        """
+        backend = cache.SQLiteCache(
+            os.path.join(self.temp_dir, 'missing', 'cache.sqlite')
+        )
+        with patch.object(cache.LOG, 'warning') as warning:
+            backend['key'] = {'time': 1, 'value': 1}
+            self.assertIsNone(backend.get('key'))
+        self.assertEqual(warning.call_count, 2)
+
+    def test_sqlite_cache_processes(self):
+        """
+        Test concurrent writes and reads of the cache by processes.
+        """
+        workers = [
+            multiprocessing.Process(
+                target=fill_shared_cache,
+                args=(self.cache_file, worker, 50)
+            )
+            for worker in xrange(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        self.assertListEqual(
+            [worker.exitcode for worker in workers],
+            [0, 0, 0, 0]
+        )
+        backend = cache.SQLiteCache(self.cache_file)
+        for worker in xrange(4):
+            self.assertEqual(
+                backend.get('%d-49' % worker)['value'],
+                worker * 49
+            )
+        self.assertEqual(backend.get('shared')['value'][1], 49)
+
+    def test_depends_on_shared(self):
+        """
+        Test that a result computed in one process serves the others.
+        """
+        calls = []
+
+        @utils.depends_on(user='user_id', serialize=True)
+        def shared_result(user_id):
+            """
+            Records calls in this process.
+            """
+            calls.append(user_id)
+            return [user_id]
+
+        worker = multiprocessing.Process(target=shared_result, args=(10,))
+        worker.start()
+        worker.join(60)
+        self.assertEqual(worker.exitcode, 0)
+
+        hits = utils.CACHE_STATS['shared_hits']
+        self.assertEqual(shared_result(10), '[10]')
+        self.assertListEqual(calls, [])
+        self.assertEqual(utils.CACHE_STATS['shared_hits'], hits + 1)
+        self.assertEqual(shared_result(11), '[11]')
+        self.assertListEqual(calls, [11])
+
+        utils.CACHE_STORAGE = {}
+        backend = utils.get_shared_cache()
+        entry = backend.get("shared_result['10'][]")
+        backend["shared_result['10'][]"] = dict(entry, tag='old')
+        self.assertEqual(shared_result(10), '[10]')
+        self.assertListEqual(calls, [11, 10])
+
+    def test_memoize_shared(self):
+        """
+        Test that shared memoized results are read from the shared cache.
+        """
+        utils.get_users(TEST_DATA_XML)
+        utils.CACHE_STORAGE = {}
+        with patch.object(utils, 'parse_tree') as parse_tree:
+            self.assertEqual(len(utils.get_users(TEST_DATA_XML)), 6)
+        self.assertFalse(parse_tree.called)
+
+
+class PresenceAnalyzerOrgTestCase(unittest.TestCase):
+    """
+    Organisation-wide statistics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.APP.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def test_get_columns(self):
+        """
+        Test for presence data converted into columns.
+        """
+        columns = org.get_columns()
+        self.assertListEqual(
+            columns['user_id'].tolist(),
+            [10, 10, 10, 11, 11, 11, 11, 11, 11]
+        )
+        self.assertEqual(len(columns['ordinal']), 9)
+        self.assertListEqual(
+            org.weekdays(columns['ordinal']).tolist(),
+            [
+                day.weekday()
+                for user_id in (10, 11)
+                for day in utils.get_data()[user_id]
+            ]
+        )
+
+    def test_vectorized_against_reference(self):
+        """
+        Test that vectorized statistics match pure Python ones.
+        """
+        columns = org.get_columns()
+        data = utils.get_data()
+        self.assertListEqual(
+            org.mean_start_end_by_weekday(columns),
+            org.mean_start_end_by_weekday_reference(data)
+        )
+        self.assertListEqual(
+            org.headcount_by_day(columns),
+            org.headcount_by_day_reference(data)
+        )
+        self.assertListEqual(
+            org.mean_presence_by_month(columns),
+            org.mean_presence_by_month_reference(data)
+        )
+
+    def test_benchmark(self):
+        """
+        Test that benchmark times every implementation.
+        """
+        self.assertItemsEqual(
+            org.benchmark(1).keys(),
+            [
+                'mean_start_end_by_weekday',
+                'mean_start_end_by_weekday_reference',
+                'headcount_by_day',
+                'headcount_by_day_reference',
+                'mean_presence_by_month',
+                'mean_presence_by_month_reference',
+            ]
+        )
+
+
+class PresenceAnalyzerSketchesTestCase(unittest.TestCase):
+    """
+    Quantile sketches tests.
+    """
+
+    @staticmethod
+    def exact_percentile(samples, percent):
+        """
+        Nearest-rank percentile of all samples.
+        """
+        ordered = sorted(samples)
+        return ordered[max(1, -(-percent * len(ordered) // 100)) - 1]
+
+    def test_accuracy(self):
+        """
+        Test that percentiles are within half of the bucket of exact ones.
+        """
+        generator = random.Random(0)
+        for size in (1, 7, 100, 5000):
+            samples = [
+                int(generator.gauss(9 * 3600, 3600)) % sketches.SECONDS_PER_DAY
+                for _ in xrange(size)
+            ]
+            sketch = sketches.QuantileSketch(resolution=60)
+            for sample in samples:
+                sketch.add(sample)
+            for percent in (1, 10, 50, 90, 99, 100):
+                self.assertLessEqual(
+                    abs(
+                        sketch.percentile(percent) -
+                        self.exact_percentile(samples, percent)
+                    ),
+                    30
+                )
+            self.assertLessEqual(len(sketch.counts), 1440)
+
+    def test_exact_resolution(self):
+        """
+        Test that one second buckets give exact percentiles.
+        """
+        samples = [30000, 30005, 29000, 40000, 35000]
+        sketch = sketches.QuantileSketch(resolution=1)
+        for sample in samples:
+            sketch.add(sample)
+        self.assertListEqual(
+            sketch.percentiles([10, 50, 90]),
+            [
+                self.exact_percentile(samples, percent)
+                for percent in (10, 50, 90)
+            ]
+        )
+        self.assertEqual(sketches.QuantileSketch().percentile(50), 0)
+
+    def test_merge(self):
+        """
+        Test that merged sketches equal a sketch of all samples.
+        """
+        first = sketches.QuantileSketch()
+        second = sketches.QuantileSketch()
+        whole = sketches.QuantileSketch()
+        for sample in xrange(0, 86400, 97):
+            (first if sample % 3 else second).add(sample)
+            whole.add(sample)
+        first.merge(second)
+        self.assertEqual(first.total, whole.total)
+        self.assertEqual(first.offset, whole.offset)
+        self.assertEqual(first.counts, whole.counts)
+        self.assertRaises(
+            ValueError,
+            first.merge,
+            sketches.QuantileSketch(resolution=1)
+        )
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.APP.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.listener.close()
+
+    def test_master_warm_up(self):
+        """
+        Test that an already warmed up application isn't warmed up again.
+        """
+        for warmed in (True, False):
+            warm_up = Mock()
+            master = prefork.PreforkMaster(
+                main.APP, '127.0.0.1', 0, warm_up=warm_up, warmed=warmed
+            )
+            master.listener = self.listener
+            master.alive = False
+            with patch.object(prefork.signal, 'signal'):
+                master.serve_forever()
+            self.assertEqual(warm_up.called, not warmed)
+
+    def test_master_stop(self):
+        """
+        Test that workers are killed after the graceful timeout.
+        """
+        master = prefork.PreforkMaster(
+            main.APP, '127.0.0.1', 0, graceful_timeout=0.2
+        )
+        master.children = {12345: 0}
+        started = time.time()
+        with patch.object(prefork, 'KILL_DELAY', 0):
+            with patch.object(master, 'kill_workers') as kill_workers:
+                with patch.object(master, 'reap_workers'):
+                    master.stop()
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        kill_workers.assert_called_with([12345], prefork.signal.SIGKILL)
+
+    def test_shared_socket_server(self):
+        """
+        Test serving on a shared socket and recycling after max requests.
+        """
+        server = prefork.SharedSocketServer(
+            main.APP,
+            self.listener,
+            threads=2,
+            max_requests=2
+        )
+        self.assertIs(server.socket, self.listener)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d/api/v1/presence_weekday/10' % (
+            self.listener.getsockname()[1]
+        )
+        for _ in xrange(2):
+            response = urllib2.urlopen(url)
+            self.assertEqual(response.getcode(), 200)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(server.running)
+        self.assertEqual(server.handled_requests, 2)
+
+    def test_shared_socket_server_drain(self):
+        """
+        Test a slow request accepted before recycling is finished.
+        """
+        def slow_application(environ, start_response):
+            """
+            Answers after a while.
+            """
+            time.sleep(1.5)
+            start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+            return [b'done']
+
+        server = prefork.SharedSocketServer(
+            slow_application,
+            self.listener,
+            threads=2,
+            max_requests=1
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        response = urllib2.urlopen(
+            'http://127.0.0.1:%d/' % self.listener.getsockname()[1]
+        )
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(response.read(), 'done')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(server.thread_pool.workers, [])
+
+
+class PresenceAnalyzerExportTestCase(unittest.TestCase):
+    """
+    Bulk export tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.APP.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.client = main.APP.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def test_user_aggregates(self):
+        """
+        Test weekday aggregates of users.
+        """
+        rows = list(export.user_aggregates(utils.get_data()))
+        self.assertEqual(len(rows), 14)
+        self.assertDictEqual(
+            rows[1],
+            {
+                'user_id': 10, 'weekday': 'Tue', 'days': 1, 'total': 30047,
+                'mean': 30047.0, 'mean_start': 34745.0, 'mean_end': 64792.0,
+            }
+        )
+        self.assertEqual(rows[0]['days'], 0)
+        self.assertEqual(rows[0]['mean'], 0)
+
+        rows = list(export.user_aggregates(
+            utils.get_data(),
+            users=[11, 99],
+            since=datetime.date(2013, 9, 10),
+            until=datetime.date(2013, 9, 12)
+        ))
+        self.assertListEqual(
+            [row['user_id'] for row in rows],
+            [11] * 7
+        )
+        self.assertListEqual(
+            [row['days'] for row in rows],
+            [0, 1, 1, 1, 0, 0, 0]
+        )
+
+    def test_iter_export(self):
+        """
+        Test serializing aggregates in chunks.
+        """
+        data = utils.get_data()
+        lines = ''.join(export.iter_export(data, 'csv')).splitlines()
+        self.assertEqual(lines[0], ','.join(export.COLUMNS))
+        self.assertEqual(lines[2], '10,Tue,1,30047,30047.0,34745.0,64792.0')
+        self.assertEqual(len(lines), 15)
+        lines = ''.join(export.iter_export(data, 'ndjson')).splitlines()
+        self.assertEqual(len(lines), 14)
+        self.assertEqual(json.loads(lines[1])['total'], 30047)
+
+        with patch.object(export, 'STREAM_CHUNK_SIZE', 100):
+            chunks = list(export.iter_export(data, 'ndjson'))
+        self.assertEqual(len(chunks), 15)
+
+    def test_export_view(self):
+        """
+        Test streaming the export.
+        """
+        response = self.client.get('/api/v1/export/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(len(response.data.splitlines()), 15)
+
+        response = self.client.get(
+            '/api/v1/export/ndjson?user_id=10&since=2013-09-11'
+        )
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertListEqual(
+            [row['days'] for row in rows],
+            [0, 0, 1, 1, 0, 0, 0]
+        )
+
+        response = self.client.get('/api/v1/export/csv?since=13-09-11')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/export/csv?user_id=abc')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/export/csv?user_id=10&user_id=')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/export/xml')
+        self.assertEqual(response.status_code, 404)
+
+    def test_export_aggregates(self):
+        """
+        Test the console script writing the export to a file.
+        """
+        temp_dir = tempfile.mkdtemp()
+        output = os.path.join(temp_dir, 'export.csv')
+        try:
+            with patch.object(main.APP.config, 'from_pyfile') as from_pyfile:
+                export.export_aggregates([
+                    '--config', 'deploy.cfg', '--user', '11',
+                    '--until', '2013-09-09', '--output', output
+                ])
+            from_pyfile.assert_called_once_with('deploy.cfg')
+            with open(output) as export_file:
+                lines = export_file.read().splitlines()
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[1], '11,Mon,1,24123,24123.0,33134.0,57257.0')
+        self.assertEqual(lines[4], '11,Thu,1,22999,22999.0,34088.0,57087.0')
+
+
+class PresenceAnalyzerLoadTestCase(unittest.TestCase):
+    """
+    Load test tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.APP.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def test_build_paths(self):
+        """
+        Test drawing a weighted mix of requests from the data.
+        """
+        data = utils.get_data()
+        paths = loadtest.build_paths(data, 200, seed=1)
+        self.assertEqual(len(paths), 200)
+        self.assertListEqual(
+            loadtest.build_paths(data, 200, seed=1),
+            paths
+        )
+        self.assertIn('/api/v1/presence_weekday/10', paths)
+        self.assertIn('/api/v1/presence_weekday/11', paths)
+        self.assertTrue(any(
+            path.startswith('/api/v1/top_five/1309') for path in paths
+        ))
+        only = loadtest.build_paths(
+            data, 10, routes=[(1, '/{user_id}/{date}')], seed=1
+        )
+        days = set(day for user_days in data.values() for day in user_days)
+        for path in only:
+            user_id, date = path[1:].split('/')
+            self.assertIn(int(user_id), data)
+            self.assertIn(utils.parse_datecode(date), days)
+
+    def test_percentile(self):
+        """
+        Test nearest-rank percentiles.
+        """
+        values = range(1, 101)
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 95), 7)
+        self.assertEqual(loadtest.percentile([], 50), 0)
+
+    def test_report(self):
+        """
+        Test throughput, latency and error rate of results.
+        """
+        results = [('/a', 200, 0.01), ('/b', 404, 0.03), ('/c', 0, 0.02)]
+        result = loadtest.report(results, 0.5, 2)
+        self.assertEqual(result['requests'], 3)
+        self.assertEqual(result['throughput'], 6)
+        self.assertDictEqual(result['errors'], {'404': 1, '0': 1})
+        self.assertEqual(result['error_rate'], 0.6667)
+        self.assertEqual(result['latency_ms']['p50'], 20)
+        self.assertEqual(result['latency_ms']['max'], 30)
+
+    def test_run(self):
+        """
+        Test driving a live server with concurrent clients.
+        """
+        server = make_server('127.0.0.1', 0, main.APP, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            paths = loadtest.build_paths(utils.get_data(), 40, seed=2)
+            paths.append('/api/v1/presence_weekday/999')
+            result = loadtest.run(
+                'http://127.0.0.1:%d' % server.socket.getsockname()[1],
+                paths,
+                clients=4
+            )
+        finally:
+            server.shutdown()
+            thread.join(5)
+        self.assertEqual(result['requests'], 41)
+        self.assertEqual(result['clients'], 4)
+        self.assertGreater(result['throughput'], 0)
+        self.assertDictEqual(result['errors'], {'404': 1})
+        self.assertLessEqual(
+            result['latency_ms']['p50'],
+            result['latency_ms']['p99']
+        )
+
 
 def suite():
     """
@@ -349,6 +1888,13 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerIndexTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerOrgTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchesTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerExportTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestCase))
     return base_suite
 
 if __name__ == '__main__':
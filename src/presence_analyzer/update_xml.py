@@ -1,23 +1,33 @@
 # -*- coding: utf-8 -*-
 """
 Updates local users.xml.
+
+This runs from cron every minute, so it deliberately doesn't import
+the Flask application.
 """
 
 import os
 import urllib2
 
-from presence_analyzer.main import APP
+DEPLOY_CFG = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'parts', 'etc', 'deploy.cfg'
+)
+
+
+def read_config(path):
+    """
+    Reads python configuration file the same way Flask does.
+    """
+    config = {'__file__': path}
+    execfile(path, config)
+    return {key: value for key, value in config.items() if key.isupper()}
 
 
 def update_xml_file():
     """
     Downloads users.xml file with users data then updates local users.xml file.
     """
-    APP.config.from_pyfile(
-        os.path.join(
-            os.path.dirname(__file__), '..', '..', 'parts', 'etc', 'deploy.cfg'
-        )
-    )
-    xml_file = urllib2.urlopen(APP.config['XML_URL'])
-    with open(APP.config['DATA_XML'], 'w') as local_xml:
+    config = read_config(DEPLOY_CFG)
+    xml_file = urllib2.urlopen(config['XML_URL'])
+    with open(config['DATA_XML'], 'w') as local_xml:
         local_xml.write(xml_file.read())
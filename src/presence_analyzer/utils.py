@@ -5,21 +5,97 @@ Helper functions used in views.
 
 import calendar
 import csv
+import heapq
+import inspect
 import logging
+import os
 import time
 import locale
 
+from collections import namedtuple
 from datetime import datetime
-from flask import Response
-from functools import wraps
+from flask import Response, abort, g, has_request_context, request
+from functools import partial, wraps
 from json import dumps
+from lxml import etree
 from threading import Lock
 
+from presence_analyzer.cache import LocalCache, SQLiteCache
+from presence_analyzer.index import UserIndex
 from presence_analyzer.main import APP
+from presence_analyzer.shards import ShardSet, signature
+from presence_analyzer.sketches import QuantileSketch
 
 locale.setlocale(locale.LC_COLLATE, 'pl_PL.utf8')
-CACHE_STORAGE = {}
+CACHE_STORAGE = LocalCache()
+SHARED_CACHES = {}  # cache file -> SQLiteCache
+# ('user', user_id), ('date', date) or ('data',) -> keys in CACHE_STORAGE
+DEPENDENCIES = {}
+DEPENDENCIES_LOCK = Lock()
+CACHE_STATS = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidated': 0}
+LOADED = {
+    'snapshot': None, 'version': 0, 'shards': None,
+    'indexes': {},  # path -> UserIndex
+    'generation': 0,  # bumped by every invalidation of cached results
+    'index_tag': None,  # tag of indexes whose rows were last reported
+}
+RELOAD_LOCK = Lock()
+INGESTION_STATS = {'rows': 0, 'accepted': 0, 'rejected': {}, 'loaded': None}
 LOG = logging.getLogger(__name__)
+STREAM_CHUNK_SIZE = 8192
+DEFAULT_INDEX_MAX_USERS = 100
+DEFAULT_DATA_TTL = 600
+ROLLUP_PERIODS = ('week', 'month')
+BOOLEANS = {
+    '': False, '0': False, 'false': False, 'no': False, 'off': False,
+    '1': True, 'true': True, 'yes': True, 'on': True,
+}
+
+
+class InvalidRow(ValueError):
+    """
+    Presence row which doesn't pass validation.
+    """
+
+    def __init__(self, category):
+        ValueError.__init__(self, category)
+        self.category = category
+
+
+class JSONDocument(str):
+    """
+    Already serialized JSON, passed through by jsonify as it is.
+    """
+
+
+class Snapshot(namedtuple('Snapshot', [
+        'version', 'data', 'tag', 'sketches', 'rollups', 'days', 'pattern',
+        'loaded'
+])):
+    """
+    Immutable version of loaded presence data with its derived aggregates.
+
+    'days' holds presence of users by date, 'tag' names the files it was
+    loaded from, 'pattern' is DATA_CSV and 'loaded' the time it was
+    published.
+    """
+    __slots__ = ()
+
+
+class Presence(namedtuple('Presence', ['ordinal', 'start', 'end'])):
+    """
+    Presence of a user at one day.
+
+    Day is stored as date ordinal, start and end as seconds since midnight.
+    """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        """
+        Presence time in seconds.
+        """
+        return self.end - self.start
 
 
 def jsonify(function):
@@ -31,16 +107,73 @@ def jsonify(function):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        result = function(*args, **kwargs)
+        if not isinstance(result, JSONDocument):
+            result = dumps(result)
+        return Response(result, mimetype='application/json')
+    return inner
+
+
+def jsonify_list(function):
+    """
+    Creates a paginated JSON response from a list returned by wrapped function.
+
+    'cursor' and 'limit' query arguments select a page of the list, cursor
+    of the next page is sent in X-Next-Cursor header. With 'stream' query
+    argument the page is serialized item by item while it's being sent.
+    The wrapped function still builds the whole list, only serialization
+    is streamed, so the list should come from a cached helper.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        items = function(*args, **kwargs)
+        cursor = request.args.get('cursor', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        stream = BOOLEANS.get(request.args.get('stream', '').lower())
+        if cursor < 0 or limit is not None and limit < 1 or stream is None:
+            abort(400)
+        end = len(items) if limit is None else min(cursor + limit, len(items))
+        page = items[cursor:end]
+        if stream:
+            body = iter_json(page)
+        else:
+            body = dumps(page)
+        response = Response(body, mimetype='application/json')
+        if end < len(items):
+            response.headers['X-Next-Cursor'] = str(end)
+        return response
     return inner
 
 
-def memoize(duration_time):
+def iter_json(items):
+    """
+    Yields JSON array of given items in chunks of about STREAM_CHUNK_SIZE.
+    """
+    chunk = ['[']
+    size = 1
+    for i, item in enumerate(items):
+        encoded = dumps(item)
+        chunk.append(',' + encoded if i else encoded)
+        size += len(encoded) + 1
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def memoize(duration_time, shared=False, tag=None):
     """
     Cache function response for a given amount of time in seconds.
+
+    With 'shared' the response is also kept in the shared cache backend,
+    so it's computed once for all processes. 'tag' is called with the
+    function arguments and names the version of input the response is
+    computed from, a response of another version is computed again.
     """
     lock = Lock()
 
@@ -53,64 +186,707 @@ def memoize(duration_time):
             """
             This docstring will be overridden by @wraps decorator.
             """
-            f_name = function.__name__
-            arguments = [str(arg) for arg in args]
-            kwarguments = [
-                '%s:%s' % (key, hash(value)) for key, value in kwargs.items()
-            ]
             time_now = int(time.time())
-            key = '{}{}{}'.format(f_name, arguments, kwarguments)
+            key = cache_key(function, args, kwargs)
+            current = tag(*args, **kwargs) if tag is not None else None
+
+            def fresh(cached):
+                """
+                Tells whether cached entry can be returned.
+                """
+                return (
+                    cached is not None and
+                    time_now - cached['time'] < duration_time and
+                    cached.get('tag') == current
+                )
+
+            cached = CACHE_STORAGE.get(key)
+            if fresh(cached):
+                return cached['value']
             with lock:
-                if (key in CACHE_STORAGE and
-                        time_now - CACHE_STORAGE[key]['time'] < duration_time):
-                    return CACHE_STORAGE[key]['value']
+                # computed by another thread while this one was waiting
+                cached = CACHE_STORAGE.get(key)
+                if fresh(cached):
+                    return cached['value']
+                backend = get_shared_cache() if shared else None
+                if backend is not None:
+                    cached = backend.get(key)
+                    if fresh(cached):
+                        CACHE_STORAGE[key] = cached
+                        return cached['value']
                 value = function(*args, **kwargs)
                 CACHE_STORAGE[key] = {
                     'time': time_now,
+                    'tag': current,
                     'value': value
                 }
+                if backend is not None:
+                    backend[key] = CACHE_STORAGE[key]
                 return value
         return __memoize
     return _memoize
 
 
-@memoize(600)
+def get_shared_cache():
+    """
+    Cache backend shared by processes, None when CACHE_BACKEND isn't
+    'sqlite' and results are cached in-process only.
+    """
+    if APP.config.get('CACHE_BACKEND', 'local') != 'sqlite':
+        return None
+    path = APP.config['CACHE_FILE']
+    backend = SHARED_CACHES.get(path)
+    if backend is None:
+        backend = SHARED_CACHES.setdefault(path, SQLiteCache(path))
+    return backend
+
+
+def data_tag(shards):
+    """
+    Tag of data loaded from given shards, equal in all processes which
+    loaded the same files.
+    """
+    return repr(sorted((shard.path, shard.signature) for shard in shards))
+
+
+def cache_key(function, args, kwargs):
+    """
+    Key of function call result in CACHE_STORAGE.
+    """
+    arguments = [str(arg) for arg in args]
+    kwarguments = [
+        '%s:%s' % (key, hash(value)) for key, value in kwargs.items()
+    ]
+    return '{}{}{}'.format(function.__name__, arguments, kwarguments)
+
+
+def depends_on(user=None, date=None, serialize=False):
+    """
+    Cache function result until presence data it depends on changes.
+
+    'user' and 'date' name the function arguments holding user_id and
+    date code the result depends on, results depending on neither are
+    dropped on any change of the data. With 'serialize' the result is
+    cached as JSONDocument, also in the shared cache backend, tagged with
+    the files it was computed from.
+    """
+    def _depends_on(function):
+        """
+        This docstring will be overridden.
+        """
+        arg_names = inspect.getargspec(function).args
+
+        def argument(name, args, kwargs):
+            """
+            Value of named argument of the function call.
+            """
+            if name in kwargs:
+                return kwargs[name]
+            return args[arg_names.index(name)]
+
+        @wraps(function)
+        def __depends_on(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            # results and tags of replaced data are never cached
+            generation = LOADED['generation']
+            snapshot = None
+            # reloads the data and invalidates when it's stale
+            if date is not None:
+                try:
+                    parse_datecode(argument(date, args, kwargs))
+                except ValueError:
+                    return function(*args, **kwargs)
+            if user is not None and APP.config.get('DATA_INDEXED'):
+                tag = data_tag(refresh_indexes())
+            else:
+                snapshot = get_snapshot()
+                if snapshot is not LOADED['snapshot']:
+                    # the request reads a snapshot replaced meanwhile
+                    return function(*args, **kwargs)
+                tag = snapshot.tag
+            key = cache_key(function, args, kwargs)
+            cached = CACHE_STORAGE.get(key)
+            if cached is not None:
+                CACHE_STATS['hits'] += 1
+                return cached['value']
+
+            backend = get_shared_cache() if serialize else None
+            shared = backend.get(key) if backend is not None else None
+            if shared is not None and shared['tag'] == tag:
+                CACHE_STATS['shared_hits'] += 1
+                value = shared['value']
+                backend = None
+            else:
+                CACHE_STATS['misses'] += 1
+                value = function(*args, **kwargs)
+                if serialize:
+                    value = JSONDocument(dumps(value))
+            entry = {'time': int(time.time()), 'value': value}
+            dependencies = []
+            if user is not None:
+                dependencies.append(('user', argument(user, args, kwargs)))
+            if date is not None:
+                dependencies.append(
+                    ('date', parse_datecode(argument(date, args, kwargs)))
+                )
+            if not dependencies:
+                dependencies.append(('data',))
+            with DEPENDENCIES_LOCK:
+                if (generation != LOADED['generation'] or
+                        snapshot is not None and
+                        snapshot is not LOADED['snapshot']):
+                    return value
+                CACHE_STORAGE[key] = entry
+                for dependency in dependencies:
+                    DEPENDENCIES.setdefault(dependency, set()).add(key)
+            if backend is not None:
+                backend[key] = dict(entry, tag=tag)
+            return value
+        return __depends_on
+    return _depends_on
+
+
+def changed_rows(old_data, new_data):
+    """
+    Users and dates of rows which differ between two versions of data.
+    """
+    users = set()
+    dates = set()
+    for user_id in set(old_data) | set(new_data):
+        old_days = old_data.get(user_id, {})
+        new_days = new_data.get(user_id, {})
+        if old_days == new_days:
+            continue
+        users.add(user_id)
+        for day in set(old_days) | set(new_days):
+            if old_days.get(day) != new_days.get(day):
+                dates.add(day)
+    return users, dates
+
+
+def publish_snapshot(data, tag=None):
+    """
+    Publishes freshly loaded data with its tag as the next snapshot.
+
+    Sketches, rollups and presence by date are rebuilt only for changed
+    rows, and only cached results depending on them are invalidated.
+    The data version is bumped when anything has changed.
+    """
+    old = LOADED['snapshot']
+    if old is None:
+        users, dates = None, None
+        sketches, rollups, days = {}, {}, {}
+    else:
+        if data is old.data:
+            users, dates = set(), set()
+        else:
+            users, dates = changed_rows(old.data, data)
+        sketches, rollups, days = old.sketches, old.rollups, old.days
+    sketches = rebuild_per_user(sketches, presence_sketches, data, users)
+    rollups = rebuild_per_user(rollups, presence_rollups, data, users)
+    days = rebuild_per_date(days, data, users, dates)
+    with DEPENDENCIES_LOCK:
+        if users is None or users:
+            LOADED['version'] += 1
+            invalidate(users, dates)
+        snapshot = Snapshot(
+            LOADED['version'], data, tag, sketches, rollups, days,
+            APP.config['DATA_CSV'], time.time()
+        )
+        LOADED['snapshot'] = snapshot
+    return snapshot
+
+
+def refresh_users(users):
+    """
+    Invalidates cached results depending on rows of given users which
+    have changed in an indexed file.
+    """
+    with DEPENDENCIES_LOCK:
+        invalidate(users, ())
+
+
+def invalidate(users, dates):
+    """
+    Drops cached results depending on given users, dates or on the whole
+    data. None for users drops all of them. Call with DEPENDENCIES_LOCK.
+
+    Results being computed meanwhile are not cached, as the generation
+    of cached results is bumped.
+    """
+    LOADED['generation'] += 1
+    if users is None:
+        stale = set(DEPENDENCIES)
+    else:
+        stale = set([('data',)])
+        stale.update(('user', user_id) for user_id in users)
+        stale.update(('date', day) for day in dates)
+    for dependency in stale:
+        for key in DEPENDENCIES.pop(dependency, ()):
+            if CACHE_STORAGE.pop(key, None) is not None:
+                CACHE_STATS['invalidated'] += 1
+
+
+def presence_sketches(items):
+    """
+    Start and end quantile sketches of given user's presence per weekday.
+    """
+    week = [(QuantileSketch(), QuantileSketch()) for _ in xrange(7)]
+    for day, presence in items.iteritems():
+        start_sketch, end_sketch = week[day.weekday()]
+        start_sketch.add(presence.start)
+        end_sketch.add(presence.end)
+    return week
+
+
+def presence_rollups(items):
+    """
+    Number of days, total presence time, sum of starts and sum of ends
+    of given user's presence per ISO week and per month.
+    """
+    weeks = {}  # ordinal of Monday -> totals
+    months = {}  # (year, month) -> totals
+    for day, (ordinal, start, end) in items.iteritems():
+        monday = ordinal - (ordinal + 6) % 7
+        week = weeks.get(monday)
+        if week is None:
+            week = weeks[monday] = [0, 0, 0, 0]
+        month = months.get((day.year, day.month))
+        if month is None:
+            month = months[day.year, day.month] = [0, 0, 0, 0]
+        for totals in (week, month):
+            totals[0] += 1
+            totals[1] += end - start
+            totals[2] += start
+            totals[3] += end
+    return {
+        'week': {
+            '%04d-W%02d' % datetime.fromordinal(monday).isocalendar()[:2]:
+            totals
+            for monday, totals in weeks.iteritems()
+        },
+        'month': {
+            '%04d-%02d' % month: totals
+            for month, totals in months.iteritems()
+        },
+    }
+
+
+def rebuild_per_user(per_user, build, data, users):
+    """
+    Copy of per_user dict with values of given users rebuilt from their
+    presence, None for all users. Given dict is never modified.
+    """
+    if users is None:
+        per_user = {}
+        users = data
+    elif users:
+        per_user = dict(per_user)
+    for user_id in users:
+        if user_id in data:
+            per_user[user_id] = build(data[user_id])
+        else:
+            per_user.pop(user_id, None)
+    return per_user
+
+
+def rebuild_per_date(per_date, data, users, dates):
+    """
+    Copy of per_date dict of users' presence by date with given dates
+    rebuilt for given users, None for all. Given dict is never modified.
+    """
+    if users is None:
+        per_date = {}
+        for user_id, days in data.iteritems():
+            for day, presence in days.iteritems():
+                present = per_date.get(day)
+                if present is None:
+                    present = per_date[day] = {}
+                present[user_id] = presence
+        return per_date
+    if dates:
+        per_date = dict(per_date)
+    for day in dates:
+        present = dict(per_date.get(day, ()))
+        for user_id in users:
+            presence = data.get(user_id, {}).get(day)
+            if presence is None:
+                present.pop(user_id, None)
+            else:
+                present[user_id] = presence
+        if present:
+            per_date[day] = present
+        else:
+            per_date.pop(day, None)
+    return per_date
+
+
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Presence data of the current snapshot, grouped by user_id.
 
     It creates structure like this:
     data = {
         'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
+            datetime.date(2013, 10, 1): Presence(
+                ordinal=734777, start=32400, end=63000
+            ),
+            datetime.date(2013, 10, 2): Presence(
+                ordinal=734778, start=30600, end=60300
+            ),
         }
     }
+    Equal dates are one interned datetime.date object shared by all users.
+    """
+    return get_snapshot().data
+
+
+def get_snapshot():
+    """
+    Data snapshot of the current request, taken once per request so that
+    all of the request reads one version of the data.
+    """
+    if not has_request_context():
+        return take_snapshot()
+    snapshot = getattr(g, 'snapshot', None)
+    if snapshot is None:
+        snapshot = g.snapshot = take_snapshot()
+    return snapshot
+
+
+def take_snapshot():
+    """
+    Current data snapshot, taken without any lock.
+
+    It's reloaded when it's older than DATA_TTL seconds or DATA_CSV has
+    changed. Readers of an old snapshot don't wait for a reload which is
+    already in progress.
+    """
+    snapshot = LOADED['snapshot']
+    if snapshot is None or snapshot.pattern != APP.config['DATA_CSV']:
+        return reload_snapshot()
+    ttl = APP.config.get('DATA_TTL', DEFAULT_DATA_TTL)
+    if time.time() - snapshot.loaded >= ttl:
+        return reload_snapshot(blocking=False)
+    return snapshot
+
+
+def reload_snapshot(blocking=True):
+    """
+    Loads data into the next snapshot off to the side and swaps it in.
+
+    Without 'blocking' the current snapshot is returned when another
+    thread is already reloading.
+    """
+    seen = LOADED['snapshot']
+    if not RELOAD_LOCK.acquire(blocking):
+        return seen
+    try:
+        if LOADED['snapshot'] is not seen:
+            return LOADED['snapshot']  # reloaded while this one waited
+        return load_snapshot()
+    finally:
+        RELOAD_LOCK.release()
+
+
+def load_snapshot():
+    """
+    Extracts presence data from CSV files and publishes it as a snapshot.
+
+    When DATA_CSV names more files, data of all shards is merged. When
+    no shard was parsed again, data of the current snapshot is kept.
+    """
+    shards = get_shards().get_all()
+    tag = data_tag(shards)
+    old = LOADED['snapshot']
+    if old is not None and old.tag == tag:
+        return publish_snapshot(old.data, tag)
+    if len(shards) == 1:
+        data = shards[0].data
+    else:
+        data = {}
+        for shard in shards:
+            for user_id, days in shard.data.iteritems():
+                data.setdefault(user_id, {}).update(days)
+    report_ingestion(shards)
+    return publish_snapshot(data, tag)
+
+
+def report_ingestion(sources):
+    """
+    Counts rows of freshly loaded sources in INGESTION_STATS, logs one
+    summary of rejected rows and writes them to quarantine.
+
+    Sources are shards or indexes with 'path', 'rows' and 'rejected'.
+    """
+    rejected = []
+    errors = {}
+    for source in sources:
+        name = os.path.basename(source.path)
+        for row in source.rejected:
+            errors[row[1]] = errors.get(row[1], 0) + 1
+            rejected.append([name] + row)
+    total = sum(source.rows for source in sources)
+    INGESTION_STATS.update({
+        'rows': total,
+        'accepted': total - len(rejected),
+        'rejected': errors,
+        'loaded': int(time.time()),
+    })
+    if rejected:
+        LOG.warning(
+            'Rejected %d of %d rows of %s: %s',
+            len(rejected),
+            total,
+            APP.config['DATA_CSV'],
+            ', '.join(
+                '%s: %d' % item for item in sorted(errors.iteritems())
+            )
+        )
+    quarantine(rejected)
+
+
+def get_shards():
+    """
+    Shards of presence data named by DATA_CSV.
+    """
+    shard_set = LOADED['shards']
+    if shard_set is None or shard_set.pattern != APP.config['DATA_CSV']:
+        shard_set = ShardSet(APP.config['DATA_CSV'], load_csv)
+        LOADED['shards'] = shard_set
+    return shard_set
+
+
+def get_day_data(day):
+    """
+    Presence of users at given day in the snapshot of the request.
+    """
+    return get_snapshot().days.get(day, {})
+
+
+def get_indexes():
+    """
+    User indexes of files named by DATA_CSV, used with DATA_INDEXED.
+    """
+    max_users = APP.config.get(
+        'DATA_INDEX_MAX_USERS', DEFAULT_INDEX_MAX_USERS
+    )
+    indexes = []
+    for path in get_shards().paths():
+        index = LOADED['indexes'].get(path)
+        if index is None:
+            index = LOADED['indexes'].setdefault(path, UserIndex(
+                path, parse_rows, max_users, on_reload=refresh_users,
+                validate=partial(validate_line, dates={})
+            ))
+        indexes.append(index)
+    return indexes
+
+
+def refresh_indexes():
+    """
+    User indexes loaded again when their files have changed. Rows of
+    changed files are reported like rows of loaded shards.
+    """
+    indexes = get_indexes()
+    for index in indexes:
+        index.refresh()
+    tag = data_tag(indexes)
+    if tag != LOADED['index_tag']:
+        LOADED['index_tag'] = tag
+        report_ingestion(indexes)
+    return indexes
+
+
+def get_user_data(user_id):
+    """
+    Presence of given user, None when the user has no valid rows.
+
+    With DATA_INDEXED only rows of the user are parsed, from indexed byte
+    ranges of data files, once per request. Otherwise the user is looked
+    up in get_data().
+    """
+    if not APP.config.get('DATA_INDEXED'):
+        return get_data().get(user_id)
+    if not has_request_context():
+        return read_user_data(user_id)
+    users = getattr(g, 'user_data', None)
+    if users is None:
+        users = g.user_data = {}
+    if user_id not in users:
+        users[user_id] = read_user_data(user_id)
+    return users[user_id]
+
+
+def read_user_data(user_id):
+    """
+    Presence of given user parsed from indexed byte ranges of data files,
+    None when the user has no valid rows.
+    """
+    days = None
+    for index in get_indexes():
+        user_days = index.get(user_id)
+        if not user_days:
+            continue
+        if days is None:
+            days = user_days
+        else:
+            days = dict(days)
+            days.update(user_days)
+    return days
+
+
+def parse_rows(lines):
+    """
+    Presence of one user from CSV lines, invalid rows are skipped.
+    They're reported when the index is built, see validate_line.
+    """
+    days = {}
+    dates = {}
+    for row in csv.reader(lines):
+        try:
+            _, date, start, end = validate_row(row, dates)
+        except InvalidRow:
+            continue
+        days[date] = Presence(date.toordinal(), start, end)
+    return days
+
+
+def load_csv(path):
+    """
+    Extracts presence data from one CSV file.
+
+    Returns data, number of rows and rejected rows with their line numbers
+    and error categories. The header and blank lines are not rows.
     """
     data = {}
-    with open(APP.config['DATA_CSV'], 'r') as csvfile:
+    dates = {}
+    rejected = []
+    total = 0
+    with open(path, 'r') as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
+        for number, row in enumerate(presence_reader, 1):
+            if is_header(number, row):
                 continue
-
+            total += 1
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                LOG.debug('Problem with line %d: ', i, exc_info=True)
+                user_id, date, start, end = validate_row(row, dates)
+            except InvalidRow as error:
+                rejected.append([number, error.category] + row)
+                continue
+
+            data.setdefault(user_id, {})[date] = Presence(
+                date.toordinal(), start, end
+            )
+    return data, total, rejected
+
+
+def is_header(number, row):
+    """
+    Tells whether CSV row at given line number is the header or a blank
+    line, which are skipped without counting.
+    """
+    return not row or number == 1 and row[0] == 'user_id'
+
+
+def validate_line(number, line, dates):
+    """
+    Validates CSV line at given line number for a user index.
+
+    Returns None for the header and blank lines, an empty list for a valid
+    row and [category] + fields of a rejected one.
+    """
+    row = next(csv.reader([line]), [])
+    if is_header(number, row):
+        return None
+    try:
+        validate_row(row, dates)
+    except InvalidRow as error:
+        return [error.category] + row
+    return []
+
+
+def validate_row(row, dates):
+    """
+    Validates and converts presence row.
+
+    Returns user_id, interned date from dates, start and end in seconds
+    since midnight. Raises InvalidRow with category of the problem.
+    """
+    if len(row) != 4:
+        # header and footer lines too
+        raise InvalidRow('columns')
+    try:
+        user_id = int(row[0])
+    except ValueError:
+        raise InvalidRow('user_id')
+    date = dates.get(row[1])
+    if date is None:
+        try:
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+        except ValueError:
+            raise InvalidRow('date')
+        dates[row[1]] = date
+    try:
+        start = parse_time(row[2])
+        end = parse_time(row[3])
+    except ValueError:
+        raise InvalidRow('time')
+    if end < start:
+        raise InvalidRow('interval')
+    return user_id, date, start, end
+
+
+def quarantine(rejected):
+    """
+    Writes rejected rows with their file names, line numbers and error
+    categories to DATA_QUARANTINE file, if it's configured.
+    """
+    path = APP.config.get('DATA_QUARANTINE')
+    if not path:
+        return
+    try:
+        with open(path, 'wb') as quarantine_file:
+            csv.writer(quarantine_file).writerows(rejected)
+    except IOError:
+        LOG.exception('Quarantine file %s can\'t be written.', path)
+
+
+def parse_datecode(given_date):
+    """
+    Converts date code (YYMMDD) to datetime.date.
+    """
+    return datetime.strptime(str(given_date), '%y%m%d').date()
+
+
+def parse_time(text):
+    """
+    Parses HH:MM:SS time into seconds since midnight.
+    """
+    hours, minutes, seconds = text.split(':')
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError('Time out of range: {}'.format(text))
+    return hours * 3600 + minutes * 60 + seconds
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
-    return data
+
+def warm_up():
+    """
+    Reloads presence data and its indexes so that the first request
+    doesn't pay for parsing.
+    """
+    CACHE_STORAGE.clear()
+    if APP.config.get('DATA_INDEXED'):
+        refresh_indexes()
+    else:
+        reload_snapshot()
+        get_days_listing()
+    try:
+        get_user_directory(APP.config['DATA_XML'])
+    except (IOError, ValueError):
+        LOG.warning('Users XML file can\'t be loaded.', exc_info=True)
 
 
 def group_by_weekday(items):
@@ -118,10 +894,8 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for date, presence in items.iteritems():
+        result[date.weekday()].append(presence.end - presence.start)
     return result
 
 
@@ -151,19 +925,36 @@ def mean_presence_hours(items):
     Calculate start and end of presence time of given user grouped by weekday.
     """
     week = {i: {'start': [], 'end': []} for i in xrange(7)}
-    for day in items:
-        week[day.weekday()]['start'].append(
-            seconds_since_midnight(items[day]['start'])
-        )
-        week[day.weekday()]['end'].append(
-            seconds_since_midnight(items[day]['end'])
-        )
+    for day, presence in items.iteritems():
+        week[day.weekday()]['start'].append(presence.start)
+        week[day.weekday()]['end'].append(presence.end)
     return [
         [calendar.day_abbr[k], mean(v['start']), mean(v['end'])]
         for k, v in week.iteritems()
     ]
 
 
+def weekday_totals(items, since=None, until=None):
+    """
+    Number of days, total presence time, sum of starts and sum of ends
+    grouped by weekday, in one pass over presence entries.
+
+    'since' and 'until' limit entries to an inclusive range of dates.
+    """
+    week = [[0, 0, 0, 0] for _ in xrange(7)]
+    for day, presence in items.iteritems():
+        if since is not None and day < since:
+            continue
+        if until is not None and day > until:
+            continue
+        totals = week[day.weekday()]
+        totals[0] += 1
+        totals[1] += presence.end - presence.start
+        totals[2] += presence.start
+        totals[3] += presence.end
+    return week
+
+
 def parse_tree(root):
     """
     Parsing xml root.
@@ -185,31 +976,172 @@ def parse_tree(root):
     ], key=lambda user: user['name'], cmp=locale.strcoll)
 
 
+def file_tag(path):
+    """
+    Tag of the file version for memoize, None when it's missing.
+    """
+    try:
+        return repr(signature(path))
+    except OSError:
+        return None
+
+
+@memoize(600, shared=True, tag=file_tag)
+def get_users(xml_file):
+    """
+    Parses users XML file, returns users sorted by name.
+    """
+    return parse_tree(etree.parse(xml_file))
+
+
+@memoize(600, shared=True, tag=file_tag)
+def get_user_directory(xml_file):
+    """
+    Users from XML file by user_id.
+    """
+    return {user['user_id']: user for user in get_users(xml_file)}
+
+
+@depends_on(user='user_id')
+def get_user_summary(user_id):
+    """
+    Total and mean presence time, mean start and end of given user grouped
+    by weekday, in the formats of the separate per-user views.
+    """
+    presence_weekday = [('Weekday', 'Presence (s)')]
+    mean_time_weekday = []
+    presence_start_end = []
+    week = weekday_totals(get_user_data(user_id))
+    for weekday, (days, total, starts, ends) in enumerate(week):
+        name = calendar.day_abbr[weekday]
+        presence_weekday.append((name, total))
+        mean_time_weekday.append((name, float(total) / days if days else 0))
+        presence_start_end.append([
+            name,
+            float(starts) / days if days else 0,
+            float(ends) / days if days else 0,
+        ])
+    return {
+        'presence_weekday': presence_weekday,
+        'mean_time_weekday': mean_time_weekday,
+        'presence_start_end': presence_start_end,
+    }
+
+
+@depends_on(user='user_id')
+def get_user_weekdays(user_id):
+    """
+    Presence intervals of given user grouped by weekday.
+    """
+    return group_by_weekday(get_user_data(user_id))
+
+
+@depends_on(user='user_id')
+def get_user_presence_hours(user_id):
+    """
+    Mean start and end of presence of given user grouped by weekday.
+    """
+    return mean_presence_hours(get_user_data(user_id))
+
+
+@depends_on()
 def get_all_days():
     """
     Get list of all day dates from data.
     """
-    data = get_data()
-    days = {}
-    days = {
+    return {
         int(day.strftime('%y%m%d')): day.strftime('%d.%m.%y')
-        for user in data.keys()
-        for day in data[user]
-        if day.strftime('%d.%m.%y') not in days
+        for day in get_snapshot().days
     }
-    return days
 
 
+@depends_on()
+def get_days_listing():
+    """
+    Date codes and labels of all days in order of dates.
+    """
+    return sorted(get_all_days().iteritems())
+
+
+@depends_on(date='given_date')
 def get_employees(given_date):
     """
     Get list of employees that have been working at given date.
     """
-    data = get_data()
-    date_object = datetime.strptime(str(given_date), "%y%m%d").date()
-    employees = {
-        user: interval(data[user][date]['start'], data[user][date]['end'])
-        for user in data
-        for date in data[user]
-        if date == date_object
+    day_data = get_day_data(parse_datecode(given_date))
+    return {
+        user: presence.duration for user, presence in day_data.iteritems()
     }
-    return employees
+
+
+@depends_on(user='user_id')
+def get_rollup(user_id, period):
+    """
+    Number of days, total presence time, mean start and mean end
+    of given user per 'week' or 'month', in order of periods.
+    """
+    if APP.config.get('DATA_INDEXED'):
+        rollup = presence_rollups(get_user_data(user_id))[period]
+    else:
+        rollup = get_snapshot().rollups[user_id][period]
+    return [
+        [label, days, total, float(starts) / days, float(ends) / days]
+        for label, (days, total, starts, ends) in sorted(rollup.iteritems())
+    ]
+
+
+def get_presence_distribution(user_id, percents=(10, 50, 90)):
+    """
+    Percentiles of start and end of presence of given user
+    for every weekday and for all of them merged.
+    """
+    if APP.config.get('DATA_INDEXED'):
+        week = presence_sketches(get_user_data(user_id))
+    else:
+        week = get_snapshot().sketches[user_id]
+    all_days = (QuantileSketch(), QuantileSketch())
+    rows = []
+    for weekday, (start_sketch, end_sketch) in enumerate(week):
+        all_days[0].merge(start_sketch)
+        all_days[1].merge(end_sketch)
+        rows.append((calendar.day_abbr[weekday], start_sketch, end_sketch))
+    rows.append(('All', all_days[0], all_days[1]))
+    return [
+        {
+            'weekday': name,
+            'count': start_sketch.total,
+            'start': dict(zip(
+                ['p%d' % percent for percent in percents],
+                start_sketch.percentiles(percents)
+            )),
+            'end': dict(zip(
+                ['p%d' % percent for percent in percents],
+                end_sketch.percentiles(percents)
+            )),
+        }
+        for name, start_sketch, end_sketch in rows
+    ]
+
+
+def get_top_employees(given_date, directory, limit=5):
+    """
+    Get employees with longest presence time at given date, joined with
+    their names and avatars. Employees missing from directory are skipped.
+    """
+    top = heapq.nlargest(
+        limit,
+        (
+            (presence, user_id)
+            for user_id, presence in get_employees(given_date).iteritems()
+            if user_id in directory
+        )
+    )
+    return [
+        {
+            'user_id': user_id,
+            'name': directory[user_id]['name'],
+            'avatar': directory[user_id]['avatar'],
+            'presence': presence,
+        }
+        for presence, user_id in top
+    ]
@@ -4,21 +4,42 @@ Defines views.
 """
 
 import calendar
+import hashlib
 import logging
+import os
 
-from flask import abort, redirect, url_for
-from flask_mako import render_template
-from lxml import etree
+from datetime import datetime
+from flask import Response, abort, g, redirect, request, url_for
+from flask_mako import TemplateError, _lookup, render_template
 from mako import exceptions
-from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer import export, org
 from presence_analyzer.main import APP
 from presence_analyzer.utils import (
-    get_data, group_by_weekday, jsonify, mean, mean_presence_hours,
-    parse_tree, get_all_days, get_employees
+    CACHE_STATS, INGESTION_STATS, ROLLUP_PERIODS, depends_on,
+    get_data, get_snapshot, get_user_weekdays, get_user_presence_hours,
+    jsonify, jsonify_list, mean,
+    get_days_listing, get_employees, get_presence_distribution, get_rollup,
+    get_top_employees, get_user_data, get_user_directory, get_user_summary,
+    get_users
 )
 
 LOG = logging.getLogger(__name__)
+LAYOUT_TEMPLATES = ('base.html',)
+PAGES = {}  # page name -> page info, None when its template doesn't compile
+PAGE_CACHE = {}
+
+
+@APP.after_request
+def add_data_version(response):
+    """
+    Tells API clients which version of data their response comes from,
+    when the response was computed from a snapshot.
+    """
+    snapshot = getattr(g, 'snapshot', None)
+    if request.path.startswith('/api/') and snapshot is not None:
+        response.headers['X-Data-Version'] = str(snapshot.version)
+    return response
 
 
 @APP.route('/')
@@ -33,14 +54,13 @@ def mainpage():
 
 
 @APP.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify_list
 def users_view():
     """
-    Users listing for dropdown.
+    Users listing for dropdown, optionally paginated or streamed.
     """
     try:
-        tree = etree.parse(APP.config['DATA_XML'])
-        users = parse_tree(tree)
+        users = get_users(APP.config['DATA_XML'])
     except IOError:
         LOG.exception('FileError!')
         abort(404)
@@ -51,18 +71,31 @@ def users_view():
         return users
 
 
+@APP.route('/api/v1/stats', methods=['GET'])
+@jsonify
+def stats_view():
+    """
+    Data ingestion and cache counters for monitoring.
+    """
+    return {
+        'version': get_snapshot().version,
+        'ingestion': INGESTION_STATS,
+        'cache': CACHE_STATS,
+    }
+
+
 @APP.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@depends_on(user='user_id', serialize=True)
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    if get_user_data(user_id) is None:
         LOG.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
+    weekdays = get_user_weekdays(user_id)
     result = [
         (calendar.day_abbr[weekday], mean(intervals))
         for weekday, intervals in enumerate(weekdays)
@@ -72,16 +105,16 @@ def mean_time_weekday_view(user_id):
 
 @APP.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@depends_on(user='user_id', serialize=True)
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    if get_user_data(user_id) is None:
         LOG.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
+    weekdays = get_user_weekdays(user_id)
     result = [
         (calendar.day_abbr[weekday], sum(intervals))
         for weekday, intervals in enumerate(weekdays)
@@ -93,53 +126,249 @@ def presence_weekday_view(user_id):
 
 @APP.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
 @jsonify
+@depends_on(user='user_id', serialize=True)
 def mean_presence_hours_view(user_id):
     """
     Returns start and end of presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    if get_user_data(user_id) is None:
         LOG.debug('User %s not found!', user_id)
         abort(404)
-    return mean_presence_hours(data[user_id])
+    return get_user_presence_hours(user_id)
 
 
-@APP.route('/api/v1/days/', methods=['GET'])
+@APP.route('/api/v1/user_summary/<int:user_id>', methods=['GET'])
 @jsonify
+def user_summary_view(user_id):
+    """
+    Returns presence_weekday, mean_time_weekday and presence_start_end
+    of given user computed in one pass, with user's name and avatar.
+    """
+    if get_user_data(user_id) is None:
+        LOG.debug('User %s not found!', user_id)
+        abort(404)
+    try:
+        user = get_user_directory(APP.config['DATA_XML']).get(user_id, {})
+    except (IOError, ValueError):
+        LOG.warning('Users XML file can\'t be loaded.', exc_info=True)
+        user = {}
+    summary = dict(get_user_summary(user_id))
+    summary.update({
+        'user_id': user_id,
+        'name': user.get('name'),
+        'avatar': user.get('avatar'),
+    })
+    return summary
+
+
+@APP.route('/api/v1/rollup/<period>/<int:user_id>', methods=['GET'])
+@jsonify_list
+def rollup_view(period, user_id):
+    """
+    Presence days, total time, mean start and end of given user per ISO
+    week or month, optionally paginated or streamed.
+    """
+    if period not in ROLLUP_PERIODS:
+        LOG.debug('Period %s not found!', period)
+        abort(404)
+    if get_user_data(user_id) is None:
+        LOG.debug('User %s not found!', user_id)
+        abort(404)
+    return get_rollup(user_id, period)
+
+
+@APP.route('/api/v1/presence_distribution/<int:user_id>', methods=['GET'])
+@jsonify
+@depends_on(user='user_id', serialize=True)
+def presence_distribution_view(user_id):
+    """
+    Returns median, 10th and 90th percentile of start and end of presence
+    of given user grouped by weekday.
+    """
+    if get_user_data(user_id) is None:
+        LOG.debug('User %s not found!', user_id)
+        abort(404)
+    return get_presence_distribution(user_id)
+
+
+@APP.route('/api/v1/days/', methods=['GET'])
+@jsonify_list
 def view_all_days():
     """
-    Dates listing for dropdown.
+    Dates listing for dropdown, optionally paginated or streamed.
     """
-    return sorted(get_all_days().items())
+    return get_days_listing()
+
+
+@APP.route('/api/v1/export/<output_format>', methods=['GET'])
+def export_view(output_format):
+    """
+    Streams weekday aggregates of all users as CSV or NDJSON.
+
+    'user_id' query arguments limit the export to given users, 'since'
+    and 'until' to a range of YYYY-MM-DD dates.
+    """
+    if output_format not in export.FORMATS:
+        abort(404)
+    try:
+        since = export.parse_date(request.args.get('since'))
+        until = export.parse_date(request.args.get('until'))
+        users = [
+            int(user_id) for user_id in request.args.getlist('user_id')
+        ] or None
+    except ValueError:
+        abort(400)
+    return Response(
+        export.iter_export(get_data(), output_format, users, since, until),
+        mimetype=export.FORMATS[output_format]
+    )
 
 
 @APP.route('/api/v1/top_five/<int:given_date>', methods=['GET'])
 @jsonify
+@depends_on(date='given_date', serialize=True)
 def view_top_five_employees(given_date):
     """
     Returns five top employees that have longest presence time at given date.
     """
-    days = get_all_days()
-    if given_date not in days:
+    try:
+        employees = get_employees(given_date)
+    except ValueError:
+        employees = None
+    if not employees:
+        LOG.debug('Wrong date (%s) or date doesn\'t exist.', given_date)
+        abort(404)
+    return sorted(employees.items(), key=lambda val: val[1], reverse=True)
+
+
+@APP.route('/api/v1/org/mean_start_end', methods=['GET'])
+@jsonify
+@depends_on(serialize=True)
+def org_mean_start_end_view():
+    """
+    Returns mean start and end of presence of all users grouped by weekday.
+    """
+    return org.mean_start_end_by_weekday(org.get_columns())
+
+
+@APP.route('/api/v1/org/headcount', methods=['GET'])
+@jsonify_list
+@depends_on()
+def org_headcount_view():
+    """
+    Number of present users per day, optionally paginated or streamed.
+    """
+    return org.headcount_by_day(org.get_columns())
+
+
+@APP.route('/api/v1/org/monthly_presence', methods=['GET'])
+@jsonify
+@depends_on(serialize=True)
+def org_monthly_presence_view():
+    """
+    Returns mean presence time per present user and day grouped by month.
+    """
+    return org.mean_presence_by_month(org.get_columns())
+
+
+@APP.route('/api/v1/top_employees/<int:given_date>', methods=['GET'])
+@jsonify
+def view_top_employees(given_date):
+    """
+    Returns top employees with names and avatars at given date.
+
+    Number of employees is given by 'limit' query argument, 5 by default.
+    """
+    try:
+        present = get_employees(given_date)
+    except ValueError:
+        present = None
+    if not present:
         LOG.debug('Wrong date (%s) or date doesn\'t exist.', given_date)
         abort(404)
-    return sorted(
-        get_employees(given_date).items(),
-        key=lambda val: val[1],
-        reverse=True
-    )
+    limit = request.args.get('limit', 5, type=int)
+    if limit < 1:
+        abort(400)
+    try:
+        directory = get_user_directory(APP.config['DATA_XML'])
+    except IOError:
+        LOG.exception('FileError!')
+        abort(404)
+    except ValueError:
+        LOG.exception('ParsingError!')
+        abort(500)
+    return get_top_employees(given_date, directory, limit)
 
 
 @APP.route('/<template_name>', methods=['GET'])
 def render_correct_template(template_name):
     """
     Check and render correct template for given url.
+
+    Only pages from the registry are rendered, anything else is rejected
+    without touching the template loader. Rendered pages are cached and
+    served with ETag and Last-Modified headers.
     """
-    try:
-        return render_template(template_name + '.html')
-    except TopLevelLookupException:
+    if not PAGES:
+        precompile_templates()
+    if template_name not in PAGES:
         LOG.debug('Template %s.html not found.', template_name)
         abort(404)
-    except exceptions.html_error_template().render():
+    if PAGES[template_name] is None:
         LOG.debug('Template error in %s.html.', template_name)
         abort(500)
+
+    key = (template_name, request.script_root)
+    page = PAGE_CACHE.get(key)
+    if page is None or APP.debug:
+        try:
+            body = render_template(template_name + '.html')
+        except TemplateError:
+            LOG.exception('Template error in %s.html.', template_name)
+            abort(500)
+        page = {
+            'body': body,
+            'etag': hashlib.md5(body).hexdigest(),
+            'last_modified': PAGES[template_name]['last_modified'],
+        }
+        PAGE_CACHE[key] = page
+
+    response = Response(page['body'], mimetype='text/html')
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    return response.make_conditional(request)
+
+
+def precompile_templates():
+    """
+    Compiles page templates and builds the registry of allowed pages.
+
+    Templates which don't compile are registered as None.
+    """
+    lookup = _lookup(APP)  # pylint: disable=protected-access
+    template_dir = os.path.join(APP.root_path, APP.template_folder)
+    layouts_modified = max(
+        os.path.getmtime(os.path.join(template_dir, layout))
+        for layout in LAYOUT_TEMPLATES
+    )
+    pages = {}
+    for file_name in sorted(os.listdir(template_dir)):
+        page_name, extension = os.path.splitext(file_name)
+        if extension != '.html' or file_name in LAYOUT_TEMPLATES:
+            continue
+        try:
+            lookup.get_template(file_name)
+        except exceptions.MakoException:
+            LOG.warning('Template %s doesn\'t compile.', file_name)
+            pages[page_name] = None
+            continue
+        modified = max(
+            os.path.getmtime(os.path.join(template_dir, file_name)),
+            layouts_modified
+        )
+        pages[page_name] = {
+            'last_modified': datetime.utcfromtimestamp(int(modified)),
+        }
+    PAGE_CACHE.clear()
+    PAGES.clear()
+    PAGES.update(pages)